@@ -1,8 +1,11 @@
+import asyncio
 import re
-from typing import Any, List, NamedTuple, Optional, Dict
+from typing import Any, Callable, List, NamedTuple, Optional, Dict, Tuple
 
 from test.test_enum import classproperty
 
+from agents.checkpoint import CheckpointStep, CheckpointStore, checkpoint_id
+from agents.repair import match_name, match_variable, parse_variable_list, repair_action
 from agents.task import Task
 from channels.channel import Channel
 from commands.command import (
@@ -12,9 +15,15 @@ from commands.command import (
     Variable,
 )
 from commands.executor import CommandExecuter
-from commands.registry import CommandRegistry
+from commands.registry import SOURCE_VECTOR, CommandRegistry, ScoredCommand
+from commands.variables import VariableStore, materialize
+from commands.sequential import SequentialCommandStepCommand
 from langchain import LLMChain, PromptTemplate
 from langchain.llms.base import BaseLLM
+from utils.llm import CompletionCache, arun_chain, cached_completion
+from utils.metrics import Metrics
+from utils.tokens import count_tokens
+from utils.tracing import Span, current_span, span, traced
 
 
 class AgentAction(NamedTuple):
@@ -30,12 +39,15 @@ class AgentAction(NamedTuple):
 class AgentActionResult(NamedTuple):
     """
     Represents the result of an action that the agent took.
+
+    @param command_inputs: the input the command received, built from the input variables (None if not built)
     """
 
     command: Command
     inputs: List[Variable]
     outputs: Any
     error: str
+    command_inputs: Any = None
 
 
 class AgentEnvironment(NamedTuple):
@@ -67,6 +79,132 @@ class AgentRun(NamedTuple):
     task: Task
     result: Any
     steps: List[AgentStep]
+    metrics: Optional[Metrics] = None
+
+
+class _RenderedStep(NamedTuple):
+    text: str
+    tokens: int
+    summary: str
+    summary_tokens: int
+
+
+class PlanningPrompt:
+    """
+    Rendered parts of the planning prompt for a single run.
+
+    The commands never change during a run, so that they are rendered once and stay byte-identical across the steps.
+    Variables and steps are rendered once when they appear.
+
+    The scratchpad keeps the recent steps verbatim and collapses older ones into one-line summaries,
+    dropping the failed steps once the same command succeeds later. When a token budget is set,
+    the oldest summaries are dropped and then older recent steps are collapsed until the scratchpad fits.
+
+    @param task: the task text
+    @param commands: the commands available in the run
+    @param model: name of the planning model to count tokens with
+    @param token_budget: maximum number of tokens of the scratchpad, or None for no limit
+    @param recent_steps: number of the latest steps to keep verbatim
+    """
+
+    task: str
+    commands: str
+    command_names: str
+    model: str
+    token_budget: Optional[int]
+    recent_steps: int
+    scratchpad_tokens: int = 0
+
+    def __init__(
+        self,
+        task: str,
+        commands: Dict[str, Command],
+        model: str = "",
+        token_budget: Optional[int] = None,
+        recent_steps: int = 3,
+    ):
+        self.task = task
+        self.commands = "\n\n".join(
+            map(
+                lambda c: f"{c.name}\n- Description: {c.description}\n- Input: {c.input_schema.string()}\n- Output: {c.output_schema.string()}",
+                commands.values(),
+            )
+        )
+        self.command_names = ",".join(commands.keys())
+        self.model = model
+        self.token_budget = token_budget
+        self.recent_steps = recent_steps
+
+        self._variable_lines: Dict[str, str] = {}
+        self._steps: List[_RenderedStep] = []
+
+    def variables(self, variables: Dict[str, Variable]) -> Tuple[str, str]:
+        """
+        @return: (variable descriptions, variable names)
+        """
+
+        for v in variables.values():
+            if v.name not in self._variable_lines:
+                self._variable_lines[v.name] = f"{v.name}: {v.description}"
+
+        variable_descriptions = "\n".join(self._variable_lines[name] for name in variables.keys())
+        variable_names = ",".join(map(lambda v: f'"{v}"', variables.keys()))
+        return variable_descriptions, variable_names
+
+    def _render_step(self, step: AgentStep) -> _RenderedStep:
+        text = "\n".join(
+            [
+                f"Thought: {step.action.thought}",
+                f"Command: {step.action.command}",
+                f"Input variables: {step.action.input_variables}",
+                f"Observation: {step.observation}",
+            ]
+        )
+        command = f"{step.action.command}({', '.join(step.action.input_variables)})"
+        summary = f"Step {step.id}: {command} => {step.observation}"
+        return _RenderedStep(text, count_tokens(text, self.model), summary, count_tokens(summary, self.model))
+
+    def scratchpad(self, step_history: List[AgentStep]) -> str:
+        for step in step_history[len(self._steps) :]:
+            self._steps.append(self._render_step(step))
+
+        # Failed steps are dropped from the summaries once the same command succeeds later
+        succeeded: Dict[str, int] = {}
+        for i, step in enumerate(step_history):
+            if step.result.error == "":
+                succeeded[step.action.command] = i
+
+        first_recent = max(0, len(step_history) - self.recent_steps)
+        older = [
+            i
+            for i in range(first_recent)
+            if step_history[i].result.error == "" or succeeded.get(step_history[i].action.command, -1) < i
+        ]
+        recent = list(range(first_recent, len(step_history)))
+
+        tokens = sum(self._steps[i].summary_tokens for i in older) + sum(self._steps[i].tokens for i in recent)
+        while self.token_budget is not None and tokens > self.token_budget:
+            if len(older) > 0:
+                tokens -= self._steps[older.pop(0)].summary_tokens
+            elif len(recent) > 1:
+                i = recent.pop(0)
+                tokens += self._steps[i].summary_tokens - self._steps[i].tokens
+                older.append(i)
+            else:
+                break
+
+        self.scratchpad_tokens = tokens
+        lines = [self._steps[i].summary for i in older] + [self._steps[i].text for i in recent]
+        return "\n".join(lines) + "\nThought: "
+
+
+def _next_step_number(step_history: List[AgentStep]) -> int:
+    """
+    @return: the number after the highest step taken, as the steps of a resumed run may have gaps,
+        like 0 and 2 if the run was killed before executing the step 1 planned in the same turn
+    """
+
+    return max((int(step.id) + 1 for step in step_history), default=0)
 
 
 class CommandBasedAgent:
@@ -80,6 +218,20 @@ class CommandBasedAgent:
     @param num_commands: The number of commands to be embedded in the prompt for planning.
     @param plan_max_retry: The maximum number of times to retry planning.
     @param max_step_count: The maximum number of steps to take.
+    @param scratchpad_token_budget: The maximum number of tokens of the step history in the prompt (None for no limit).
+    @param scratchpad_recent_steps: The number of the latest steps kept verbatim in the prompt.
+    @param plan_streaming: Whether to stream the planning output, stopping it as soon as the action is complete.
+        The LLM should provide `stream` like OpenAI; otherwise the whole output is awaited.
+    @param fast_path_threshold: The minimum vector similarity of a stored command to the task to execute it
+        without planning, which is also done if its description is the task text (None to always plan).
+    @param multi_action: Whether to let the planner emit several actions in one turn.
+        Actions not depending on each other's outputs are executed concurrently.
+    @param checkpoint_store: The store to persist each completed step to, so that a killed run can be resumed
+        (None to disable).
+    @param variable_store: The store to write large step outputs to, instead of keeping them in memory
+        (None to keep all in memory).
+    @param plan_completion_cache: The cache of the planning completions (None to disable).
+        The executor has its own one, command_executor.completion_cache.
     """
 
     plan_llm_chain: LLMChain
@@ -89,6 +241,14 @@ class CommandBasedAgent:
     num_commands: int = 10
     plan_max_retry: int = 3
     max_step_count: int = 10
+    scratchpad_token_budget: Optional[int] = 2000
+    scratchpad_recent_steps: int = 3
+    fast_path_threshold: Optional[float] = 0.95
+    plan_streaming: bool = False
+    multi_action: bool = False
+    checkpoint_store: Optional[CheckpointStore] = None
+    variable_store: Optional[VariableStore] = None
+    plan_completion_cache: Optional[CompletionCache] = None
 
     PROMPT = """
 Perform the following task as best as you can. You have access to the following commands and variables:
@@ -106,7 +266,7 @@ Thought: you should always think about what to do
 Command: the command to execute, should be one of [{command_names}]
 Input variables: the variables you can use in the command, should be a subset of [{variable_names}]. For example, [{variable_names}].
 Observation: the result of the command
-... (this Thought/Command/Input variables/Observation can repeat N times)
+... (this Thought/Command/Input variables/Observation can repeat N times){multi_action_note}
 Thought: I now know the final answer
 Command: ReturnCommand
 Input variables: [<variables to use>]
@@ -114,6 +274,13 @@ Input variables: [<variables to use>]
 Task: {task}{agent_scratchpad}
 """
 
+    MULTI_ACTION_NOTE = """
+When several commands are needed and some don't use each other's results, \
+you can write several Command/Input variables pairs after one Thought. They are executed at the same time, \
+and the result of the first pair is saved to steps.<N>.output variable, the second to steps.<N+1>.output, \
+and so on, where N is the number of the next step. \
+A pair can use the result of an earlier pair."""
+
     @classproperty
     # Need to set to the LLM as a stop word
     def STOP_WORD(cls) -> str:
@@ -122,41 +289,97 @@ Task: {task}{agent_scratchpad}
     def __init__(self, plan_llm: BaseLLM, command_llm: BaseLLM, channel: Channel, verbose: bool = False) -> None:
         prompt = PromptTemplate(
             template=self.PROMPT,
-            input_variables=["commands", "command_names", "variables", "variable_names", "task", "agent_scratchpad"],
+            input_variables=[
+                "commands",
+                "command_names",
+                "variables",
+                "variable_names",
+                "multi_action_note",
+                "task",
+                "agent_scratchpad",
+            ],
         )
         self.plan_llm_chain = LLMChain(llm=plan_llm, prompt=prompt, verbose=verbose)
         self.command_executor = CommandExecuter(command_llm, verbose=verbose)
         self.channel = channel
         self.verbose = verbose
 
-    def _execute_prompt(
+    async def _execute_prompt(
         self,
-        task: str,
+        prompt: PlanningPrompt,
         commands: Dict[str, Command],
         variables: Dict[str, Variable],
         agent_scratchpad: str,
+        metrics: Metrics,
     ) -> str:
         # Build input
-        command_descriptions = "\n\n".join(
-            map(
-                lambda c: f"{c.name}\n- Description: {c.description}\n- Input: {c.input_schema.string()}\n- Output: {c.output_schema.string()}",
-                commands.values(),
-            )
-        )
-        command_names = ",".join(commands.keys())
+        variable_descriptions, variable_names = prompt.variables(variables)
+        inputs = {
+            "commands": prompt.commands,
+            "command_names": prompt.command_names,
+            "variables": variable_descriptions,
+            "variable_names": variable_names,
+            "multi_action_note": self.MULTI_ACTION_NOTE if self.multi_action else "",
+            "task": prompt.task,
+            "agent_scratchpad": agent_scratchpad,
+        }
 
-        variable_descriptions = "\n".join(map(lambda v: f"{v.name}: {v.description}", variables.values()))
-        variable_names = ",".join(map(lambda v: f'"{v}"', variables.keys()))
+        text = self.plan_llm_chain.prompt.format(**inputs)
+        prompt_tokens = count_tokens(text, prompt.model)
+        metrics.increment("plan_llm_calls")
+        metrics.observe("plan_prompt_tokens", prompt_tokens)
+        metrics.observe("scratchpad_tokens", prompt.scratchpad_tokens)
+        if self.verbose:
+            print(f"Prompt tokens: {prompt_tokens} (scratchpad: {prompt.scratchpad_tokens})")
 
         # Run LLM
-        return self.plan_llm_chain.run(
-            commands=command_descriptions,
-            command_names=command_names,
-            variables=variable_descriptions,
-            variable_names=variable_names,
-            task=task,
-            agent_scratchpad=agent_scratchpad,
-        )
+        if self.plan_streaming and hasattr(self.plan_llm_chain.llm, "stream"):
+            return await cached_completion(
+                self.plan_completion_cache,
+                self.plan_llm_chain.llm,
+                text,
+                lambda: self._stream_prompt(text, commands, metrics),
+            )
+        return await arun_chain(self.plan_llm_chain, completion_cache=self.plan_completion_cache, **inputs)
+
+    async def _stream_prompt(self, prompt: str, commands: Dict[str, Command], metrics: Metrics) -> str:
+        """
+        Stream the planning output, and stop the generation as soon as the input variables line is complete
+        (unless multiple actions are allowed).
+        The execution of the command is prepared as soon as the command line is complete,
+        while the rest is still being generated.
+        """
+
+        def consume() -> str:
+            output = ""
+            command_line = False
+            stream = self.plan_llm_chain.llm.stream(prompt)
+            try:
+                for chunk in stream:
+                    output += chunk["choices"][0].get("text", "")
+
+                    if not command_line:
+                        match = re.search(r"Command:[ \t]*(.*?)[ \t]*\n", output)
+                        if match:
+                            command_line = True
+                            # An unknown name is reported to the LLM after the input variables line is complete
+                            command_name = match_name(match.group(1), list(commands.keys()))
+                            if command_name is not None:
+                                self.command_executor.prepare(commands[command_name])
+
+                    if self.multi_action:
+                        continue
+                    if re.search(r"Input variables:[ \t]*(\[[^\]\n]*\]|[^\n]*\n)", output):
+                        break
+                else:
+                    return output
+            finally:
+                stream.close()
+
+            metrics.increment("plan_streams_stopped_early")
+            return output
+
+        return await asyncio.get_running_loop().run_in_executor(None, consume)
 
     def _parse_agent_action(self, output: str) -> Optional[AgentAction]:
         """
@@ -176,96 +399,419 @@ Task: {task}{agent_scratchpad}
         command_input = match.group(3).strip()
 
         # Decode ['var1', "var2"] into List[str]
-        input_variables = list(map(lambda s: s.strip().strip("'\""), command_input.strip("[]").split(",")))
+        input_variables = parse_variable_list(command_input)
 
         return AgentAction(thought, command, input_variables)
 
-    def _build_scratchpad(self, step_history: List[AgentStep]) -> str:
-        lines: List[str] = []
-        for step in step_history:
-            lines += [
-                f"Thought: {step.action.thought}",
-                f"Command: {step.action.command}",
-                f"Input variables: {step.action.input_variables}",
-                f"Observation: {step.observation}",
-            ]
+    def _parse_agent_actions(self, output: str) -> List[AgentAction]:
+        """
+        Parse the output of the LLM into multiple AgentActions sharing the first thought.
 
-        return "\n".join(lines) + "\nThought: "
+        (Thought:) <thought>
+        Command: <command>
+        Input variables: [<var1>, <var2>]
+        Command: <command>
+        Input variables: [<var1>, <var2>]
+        """
+
+        regex = r"Command:[ \t]*(.*?)[ \t]*\n\s*Input variables:[ \t]*(.*)"
+        matches = list(re.finditer(regex, output))
+        actions: List[AgentAction] = []
+        start = 0
+        for match in matches:
+            thought = re.sub(r"^\s*Thought:\s*", "", output[start : match.start()]).strip()
+            if thought == "" and len(actions) > 0:
+                thought = actions[0].thought
+            actions.append(AgentAction(thought, match.group(1), parse_variable_list(match.group(2))))
+            start = match.end()
+        return actions
+
+    def _match_variables(
+        self, names: List[str], environment: AgentEnvironment, metrics: Metrics, pending: Optional[List[str]] = None
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Map the variable names written by the LLM to the variables in the environment,
+        like "steps.0.output.url" to "steps.0.output", or a misspelled task variable name to the closest one.
+
+        @param pending: names of the variables to be output by the preceding actions in the same turn
+        @return: (matched variable names, names not matching any variable)
+        """
 
-    def _plan(self, task: str, step_history: List[AgentStep], environment: AgentEnvironment) -> AgentAction:
+        candidates = list(environment.variables.keys()) + (pending or [])
+        variables: List[str] = []
+        unresolved: List[str] = []
+        for v in names:
+            var = match_variable(v, candidates)
+            if var is None:
+                unresolved.append(v)
+                continue
+            if var != v:
+                metrics.increment("plan_variable_repairs")
+            if var not in variables:
+                variables.append(var)
+        return variables, unresolved
+
+    async def _plan(
+        self, prompt: PlanningPrompt, step_history: List[AgentStep], environment: AgentEnvironment, metrics: Metrics
+    ) -> List[AgentAction]:
         """
-        Plan the next action to take.
+        Plan the next actions to take (only one unless multi_action is enabled).
         """
 
         current_output = ""
 
         for i in range(self.plan_max_retry):
-            output = self._execute_prompt(
-                task, environment.commands, environment.variables, self._build_scratchpad(step_history) + current_output
+            with span("agent.plan_attempt", attempt=i) as s:
+                scratchpad = prompt.scratchpad(step_history) + current_output
+                output = await self._execute_prompt(
+                    prompt, environment.commands, environment.variables, scratchpad, metrics
+                )
+                actions = self._parse_agent_actions(output) if self.multi_action else []
+                if len(actions) > 1:
+                    actions = [self._repair_command(a, environment, metrics) for a in actions]
+                else:
+                    action = self._parse_agent_action(output)
+                    if action is None or action.command not in environment.commands:
+                        # Repair common failures locally, before spending another LLM call
+                        repaired = repair_action(output, list(environment.commands.keys()))
+                        if repaired is not None:
+                            metrics.increment("plan_repairs")
+                            action = AgentAction(*repaired)
+                    actions = [action] if action is not None else []
+
+                unknown = [a.command for a in actions if a.command not in environment.commands]
+                s.set("actions", len(actions))
+                unresolved: List[str] = []
+                if len(actions) > 0 and len(unknown) == 0:
+                    # Later actions in the turn can use the outputs of the earlier ones
+                    first_step_number = _next_step_number(step_history)
+                    matched: List[AgentAction] = []
+                    for j, action in enumerate(actions):
+                        variables, missing = self._match_variables(
+                            action.input_variables,
+                            environment,
+                            metrics,
+                            [f"steps.{first_step_number + k}.output" for k in range(j)],
+                        )
+                        matched.append(AgentAction(action.thought, action.command, variables))
+                        unresolved.extend(missing)
+                    if len(unresolved) == 0:
+                        return matched
+
+                metrics.increment("plan_retries")
+                if len(actions) == 0:
+                    error = "The output does not follow the format"
+                elif len(unknown) > 0:
+                    error = f"{unknown[0]} is not one of [{prompt.command_names}]"
+                else:
+                    error = f"{unresolved[0]} is not one of [{', '.join(environment.variables.keys())}]"
+                s.set_error(error)
+                current_output = current_output + output + f"\nObservation: [Error] {error}\nThought:"
+
+        raise Exception(f"Failed to plan after {self.plan_max_retry} retries")
+
+    def _repair_command(self, action: AgentAction, environment: AgentEnvironment, metrics: Metrics) -> AgentAction:
+        if action.command in environment.commands:
+            return action
+        command = match_name(action.command, list(environment.commands.keys()))
+        if command is None:
+            return action
+        metrics.increment("plan_repairs")
+        return AgentAction(action.thought, command, action.input_variables)
+
+    async def _execute_action(
+        self, step_number: int, action: AgentAction, environment: AgentEnvironment, metrics: Metrics
+    ) -> AgentStep:
+        await self.channel.send("Action: ", action._asdict())
+        if self.verbose:
+            print(action._asdict())
+
+        command = environment.commands[action.command]
+        inputs = list(map(lambda v: environment.variables[v], action.input_variables))
+
+        [command_inputs, outputs, error] = await self.command_executor.execute_with_inputs(
+            command, inputs, self.channel, metrics
+        )
+        if error == "":
+            observation = f"Command was successful, saving the result to steps.{step_number}.output variable"
+        else:
+            observation = f"[Error] {error}"
+
+        if self.verbose:
+            print(observation)
+
+        result = AgentActionResult(
+            command=command, inputs=inputs, outputs=outputs, error=error, command_inputs=command_inputs
+        )
+        return AgentStep(id=f"{step_number}", action=action, result=result, observation=observation)
+
+    async def _execute_actions(
+        self,
+        first_step_number: int,
+        actions: List[AgentAction],
+        environment: AgentEnvironment,
+        metrics: Metrics,
+        on_step: Optional[Callable[[AgentStep], None]] = None,
+    ) -> List[AgentStep]:
+        """
+        Execute the actions planned in a turn in waves: each wave runs concurrently the actions
+        whose input variables are all available, and the outputs are saved in the order of the actions.
+        ReturnCommand runs after all the other actions.
+
+        @param on_step: called with each step once it's completed and its output is saved
+        """
+
+        steps: Dict[int, AgentStep] = {}
+        pending = list(range(len(actions)))
+        while len(pending) > 0:
+            ready = [i for i in pending if all(v in environment.variables for v in actions[i].input_variables)]
+            wave = [i for i in ready if actions[i].command != RETURN_COMMAND_NAME] or ready
+            if len(wave) == 0:
+                # The actions depend on the outputs of failed actions
+                for i in pending:
+                    action = actions[i]
+                    error = f"Input variables {action.input_variables} are not available as the previous command failed"
+                    result = AgentActionResult(environment.commands[action.command], [], None, error)
+                    steps[i] = AgentStep(f"{first_step_number + i}", action, result, f"[Error] {error}")
+                    if on_step is not None:
+                        on_step(steps[i])
+                break
+
+            results = await asyncio.gather(
+                *[self._execute_action(first_step_number + i, actions[i], environment, metrics) for i in wave]
             )
-            action = self._parse_agent_action(output)
-            if action:
-                # Modify input variables
-                variables: List[str] = []
-                for v in action.input_variables:
-                    for var in environment.variables.keys():
-                        if v.startswith(var):
-                            variables.append(var)
-                            break
+            for i, step in zip(wave, results):
+                pending.remove(i)
+                if step.result.error == "":
+                    variable = self._store_variable(
+                        Variable(
+                            f"steps.{step.id}.output",
+                            f"result of {step.action.command}({ ', '.join(step.action.input_variables) }).",
+                            step.result.outputs,
+                        )
+                    )
+                    environment.variables[variable.name] = variable
+                    if step.result.command.name != RETURN_COMMAND_NAME:
+                        # Keep only the stored value, as the step history lives as long as the run
+                        step = step._replace(result=step.result._replace(outputs=variable.value))
+                steps[i] = step
+                if on_step is not None:
+                    on_step(step)
+            if any(steps[i].result.command.name == RETURN_COMMAND_NAME for i in wave):
+                break
+
+        return [steps[i] for i in sorted(steps.keys())]
+
+    def _is_task(self, scored: ScoredCommand, task: Task) -> bool:
+        """
+        Whether a stored command is the task, rather than only relevant to it.
+        Lexical scores don't count, as any command whose description contains all the task terms has the full score.
+        """
 
-                return AgentAction(action.thought, action.command, variables)
+        if scored.source == SOURCE_VECTOR and scored.score >= self.fast_path_threshold:
+            return True
+        return " ".join(scored.command.description.lower().split()) == " ".join(task.text.lower().split())
 
-            current_output = current_output + output + "\nThought:"
+    def _matches_task(self, command: Command, task: Task) -> bool:
+        """
+        Whether a stored command performs the task by itself, taking the task inputs and returning the task outputs.
+        """
 
-        raise Exception(f"Failed to plan after {self.plan_max_retry} retries")
+        if not isinstance(command, SequentialCommandStepCommand):
+            return False
+
+        input_names = {v.name for v in task.input_variables}
+        output_names = {f.name for f in task.output_schema.fields}
+        return command.input_variables.keys() <= input_names and command.output_variables.keys() == output_names
+
+    async def _run_stored_command(self, task: Task, command: Command, metrics: Metrics) -> Optional[AgentRun]:
+        """
+        Execute a stored command matching the task without planning.
+
+        @return: the agent run if succeeded, otherwise None
+        """
+
+        action = AgentAction(
+            f"The task matches the stored command {command.name}", command.name, [v.name for v in task.input_variables]
+        )
+        await self.channel.send("Action: ", action._asdict())
+        if self.verbose:
+            print(action._asdict())
+
+        command_inputs, outputs, error = await self.command_executor.execute_with_inputs(
+            command, task.input_variables, self.channel, metrics
+        )
+        return_command = ReturnCommand(schema=task.output_schema)
+        if error == "":
+            outputs, error = await return_command.run(outputs, self.channel)
+        if error != "":
+            metrics.increment("fast_path_failures")
+            if self.verbose:
+                print(f"[Error] {error}, falling back to planning")
+            return None
 
+        metrics.increment("fast_path_runs")
+        observation = "Command was successful, saving the result to steps.0.output variable"
+        description = f"result of {command.name}({ ', '.join(action.input_variables) })."
+        output = Variable("steps.0.output", description, outputs)
+        if self.verbose:
+            print(observation)
+
+        # Recorded as the steps the planner would have taken, so that the run can be saved as a command as usual
+        steps = [
+            AgentStep(
+                "0", action, AgentActionResult(command, task.input_variables, outputs, "", command_inputs), observation
+            ),
+            AgentStep(
+                "1",
+                AgentAction("I now know the final answer", RETURN_COMMAND_NAME, [output.name]),
+                AgentActionResult(return_command, [output], outputs, "", outputs),
+                "Command was successful, saving the result to steps.1.output variable",
+            ),
+        ]
+        return AgentRun(task, outputs, steps, metrics)
+
+    def _store_variable(self, variable: Variable) -> Variable:
+        if self.variable_store is None:
+            return variable
+        return self.variable_store.put(variable)
+
+    def _checkpoint_step(self, run_id: str, step: AgentStep, environment: AgentEnvironment):
+        variable = environment.variables.get(f"steps.{step.id}.output") if step.result.error == "" else None
+        checkpoint = CheckpointStep(
+            id=step.id,
+            thought=step.action.thought,
+            command=step.action.command,
+            input_variables=step.action.input_variables,
+            inputs=[v._replace(value=materialize(v.value)) for v in step.result.inputs],
+            outputs=materialize(step.result.outputs),
+            error=step.result.error,
+            observation=step.observation,
+            variable=variable._replace(value=materialize(variable.value)) if variable is not None else None,
+            command_inputs=step.result.command_inputs,
+        )
+        self.checkpoint_store.append(run_id, checkpoint)
+
+    async def _restore_steps(
+        self, checkpoint: List[CheckpointStep], environment: AgentEnvironment, command_registry: CommandRegistry
+    ) -> List[AgentStep]:
+        """
+        Rebuild the step history and the variables of a run from its checkpoint.
+        The commands executed in the run are added to the environment if they are not there.
+        """
+
+        missing = [c.command for c in checkpoint if c.command not in environment.commands]
+        environment.commands.update(await command_registry.aresolve_many(list(dict.fromkeys(missing))))
+        missing = [name for name in missing if name not in environment.commands]
+        if len(missing) > 0:
+            raise Exception(f"Failed to resume the run: commands {missing} are not found")
+
+        step_history: List[AgentStep] = []
+        for c in checkpoint:
+            action = AgentAction(c.thought, c.command, c.input_variables)
+            outputs = c.outputs
+            if c.variable is not None:
+                variable = self._store_variable(c.variable)
+                environment.variables[variable.name] = variable
+                if c.command != RETURN_COMMAND_NAME:
+                    outputs = variable.value
+            result = AgentActionResult(environment.commands[c.command], c.inputs, outputs, c.error, c.command_inputs)
+            step_history.append(AgentStep(c.id, action, result, c.observation))
+        return step_history
+
+    @staticmethod
+    def _trace_run(s: Span, run: AgentRun):
+        s.set("steps", len(run.steps))
+        if run.metrics is not None:
+            for name, value in run.metrics.counters.items():
+                s.set(name, value)
+
+    @traced("agent.run", on_result=lambda s, run: CommandBasedAgent._trace_run(s, run))
     async def run(
         self,
         task: Task,
         command_registry: CommandRegistry,
+        run_id: Optional[str] = None,
     ) -> AgentRun:
         """
         Run the agent on the given task.
+
+        @param run_id: id of the run to checkpoint and resume, identified by the task if omitted
+            (used only with checkpoint_store). Identical tasks running at the same time need distinct ids.
         """
 
+        metrics = Metrics()
+        current_span().set("task", task.text)
+        checkpoint: List[CheckpointStep] = []
+        if self.checkpoint_store is not None:
+            run_id = run_id or checkpoint_id(task)
+            checkpoint = self.checkpoint_store.load(run_id)
+            returned = len(checkpoint) > 0 and checkpoint[-1].command == RETURN_COMMAND_NAME
+            if len(checkpoint) >= self.max_step_count and not (returned and checkpoint[-1].error == ""):
+                # The run has no step left to take, so that resuming it would only fail again
+                self.checkpoint_store.clear(run_id)
+                checkpoint = []
+
+        scored = await command_registry.aquery_with_scores(task.text, n=self.num_commands)
+
+        # Skip planning if a stored command already performs the task
+        if self.fast_path_threshold is not None and len(checkpoint) == 0:
+            for s in scored:
+                if self._is_task(s, task) and self._matches_task(s.command, task):
+                    run = await self._run_stored_command(task, s.command, metrics)
+                    if run is not None:
+                        current_span().set("fast_path", True)
+                        return run
+                    break
+
         variables = {v.name: v for v in task.input_variables}
-        commands = {
-            c.name: c
-            for c in command_registry.query(task.text, n=self.num_commands) + [ReturnCommand(schema=task.output_schema)]
-        }
+        commands = {s.command.name: s.command for s in scored}
+        commands[RETURN_COMMAND_NAME] = ReturnCommand(schema=task.output_schema)
         environment: AgentEnvironment = AgentEnvironment(
             commands=commands, variables=variables, last_action_result=None
         )
 
+        # Resume from the last completed step
         step_history: List[AgentStep] = []
-        for step_number in range(self.max_step_count):
-            action = self._plan(task.text, step_history, environment)
-            await self.channel.send("Action: ", action._asdict())
+        if len(checkpoint) > 0:
+            step_history = await self._restore_steps(checkpoint, environment, command_registry)
+            metrics.increment("resumed_steps", len(step_history))
             if self.verbose:
-                print(action._asdict())
-
-            command = environment.commands[action.command]
-            inputs = list(map(lambda v: environment.variables[v], action.input_variables))
-
-            [outputs, error] = await self.command_executor.execute(command, inputs, self.channel)
-            if error == "":
-                observation = f"Command was successful, saving the result to steps.{step_number}.output variable"
-                variables[f"steps.{step_number}.output"] = Variable(
-                    f"steps.{step_number}.output",
-                    f"result of {action.command}({ ', '.join(action.input_variables) }).",
-                    outputs,
-                )
-            else:
-                observation = f"[Error] {error}"
+                print(f"Resuming run {run_id} from step {len(step_history)}")
+
+            last = step_history[-1]
+            if last.result.command.name == RETURN_COMMAND_NAME and last.result.error == "":
+                self.checkpoint_store.clear(run_id)
+                return AgentRun(task, last.result.outputs, step_history, metrics)
+
+        def on_step(step: AgentStep):
+            if self.checkpoint_store is not None:
+                self._checkpoint_step(run_id, step, environment)
+
+        # Render the static part of the prompt once for the whole run
+        prompt = PlanningPrompt(
+            task.text,
+            commands,
+            model=getattr(self.plan_llm_chain.llm, "model_name", ""),
+            token_budget=self.scratchpad_token_budget,
+            recent_steps=self.scratchpad_recent_steps,
+        )
 
-            if self.verbose:
-                print(observation)
+        while len(step_history) < self.max_step_count:
+            actions = await self._plan(prompt, step_history, environment, metrics)
+            actions = actions[: self.max_step_count - len(step_history)]
+            metrics.observe("actions_per_plan", len(actions))
 
-            result = AgentActionResult(command=command, inputs=inputs, outputs=outputs, error=error)
-            step = AgentStep(id=f"{step_number}", action=action, result=result, observation=observation)
-            step_history.append(step)
+            steps = await self._execute_actions(_next_step_number(step_history), actions, environment, metrics, on_step)
+            step_history.extend(steps)
 
-            if command.name == RETURN_COMMAND_NAME and error == "":
-                return AgentRun(task, outputs, step_history)
+            for step in steps:
+                if step.result.command.name == RETURN_COMMAND_NAME and step.result.error == "":
+                    if self.checkpoint_store is not None:
+                        self.checkpoint_store.clear(run_id)
+                    return AgentRun(task, step.result.outputs, step_history, metrics)
 
+        # The run failed for good, so that the next run of the task starts over
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.clear(run_id)
         raise Exception(f"Failed to complete task after {self.max_step_count} steps")
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from typing import AsyncIterable, AsyncIterator, Iterable, List, NamedTuple, Optional, Set, Union
+
+from agents.agent import AgentRun, CommandBasedAgent
+from agents.checkpoint import checkpoint_id
+from agents.task import Task
+from commands.registry import CommandRegistry
+
+
+class BatchResult(NamedTuple):
+    """
+    Represents the result of a task in a batch.
+
+    @param index: position of the task in the input
+    @param task: the task
+    @param run: the agent run if succeeded, otherwise None
+    @param error: error message if failed, otherwise empty string
+    @param duration: seconds taken to run the task
+    """
+
+    index: int
+    task: Task
+    run: Optional[AgentRun]
+    error: str
+    duration: float
+
+
+class BatchReport(NamedTuple):
+    """
+    Represents a summary of a batch execution.
+    """
+
+    total: int
+    failures: int
+    elapsed: float
+    throughput: float  # tasks per second
+    p50: float  # seconds
+    p95: float  # seconds
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class BatchRunner:
+    """
+    Runs many tasks with bounded concurrency, sharing an agent and a command registry (and their caches).
+
+    @param agent: the agent to run the tasks
+    @param command_registry: the command registry shared by all the tasks
+    @param concurrency: the maximum number of tasks running at the same time
+    """
+
+    agent: CommandBasedAgent
+    command_registry: CommandRegistry
+    concurrency: int
+
+    def __init__(self, agent: CommandBasedAgent, command_registry: CommandRegistry, concurrency: int = 8):
+        self.agent = agent
+        self.command_registry = command_registry
+        self.concurrency = concurrency
+        self._results: List[BatchResult] = []
+        self._elapsed = 0.0
+
+    async def _run_task(self, index: int, task: Task) -> BatchResult:
+        started_at = time.monotonic()
+        try:
+            # Identical tasks in a batch are checkpointed apart, and each resumes on a rerun of the same input
+            run = await self.agent.run(task, self.command_registry, run_id=f"{checkpoint_id(task)}-{index}")
+            return BatchResult(index, task, run, "", time.monotonic() - started_at)
+        except Exception as e:
+            return BatchResult(index, task, None, str(e) or type(e).__name__, time.monotonic() - started_at)
+
+    async def run(self, tasks: Union[Iterable[Task], AsyncIterable[Task]]) -> AsyncIterator[BatchResult]:
+        """
+        Run the tasks, yielding the results in the order they finish.
+        Tasks are pulled from the input only when a slot is available, so that the input can be a stream.
+        """
+
+        if isinstance(tasks, AsyncIterable):
+            iterator = tasks.__aiter__()
+        else:
+            iterator = _aiter(tasks)
+
+        started_at = time.monotonic()
+        running: Set["asyncio.Task[BatchResult]"] = set()
+        index = 0
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and len(running) < self.concurrency:
+                    try:
+                        task = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    running.add(asyncio.ensure_future(self._run_task(index, task)))
+                    index += 1
+
+                if len(running) == 0:
+                    break
+
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    self._results.append(result)
+                    self._elapsed = time.monotonic() - started_at
+                    yield result
+        finally:
+            for future in running:
+                future.cancel()
+
+    def report(self) -> BatchReport:
+        """
+        @return: summary of the tasks finished so far
+        """
+
+        durations = [r.duration for r in self._results]
+        return BatchReport(
+            total=len(self._results),
+            failures=len([r for r in self._results if r.error != ""]),
+            elapsed=self._elapsed,
+            throughput=len(self._results) / self._elapsed if self._elapsed > 0 else 0.0,
+            p50=_percentile(durations, 0.5),
+            p95=_percentile(durations, 0.95),
+        )
+
+
+async def _aiter(tasks: Iterable[Task]) -> AsyncIterator[Task]:
+    for task in tasks:
+        yield task
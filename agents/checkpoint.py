@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from agents.task import Task
+from commands.command import Variable
+
+
+class CheckpointStep(NamedTuple):
+    """
+    Represents a step of an agent run persisted in a checkpoint.
+
+    @param id: id of the step
+    @param thought: thought of the action
+    @param command: name of the executed command
+    @param input_variables: names of the input variables of the action
+    @param inputs: the input variables passed to the command
+    @param outputs: outputs of the command
+    @param error: error message if failed, otherwise empty string
+    @param observation: observation of the step
+    @param variable: the variable saved by the step, or None if failed
+    @param command_inputs: the input the command received
+    """
+
+    id: str
+    thought: str
+    command: str
+    input_variables: List[str]
+    inputs: List[Variable]
+    outputs: Any
+    error: str
+    observation: str
+    variable: Optional[Variable]
+    command_inputs: Any = None
+
+
+def _variable_to_json(v: Variable) -> Dict[str, Any]:
+    return {"name": v.name, "description": v.description, "value": v.value}
+
+
+def _variable_from_json(data: Dict[str, Any]) -> Variable:
+    return Variable(data["name"], data["description"], data["value"])
+
+
+def checkpoint_id(task: Task) -> str:
+    """
+    @return: an id of the run identifying the task by its text and inputs
+    """
+
+    inputs = {v.name: v.value for v in task.input_variables}
+    body = json.dumps([task.text, inputs], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+
+
+class CheckpointStore:
+    """
+    A local append-only store of the completed steps of agent runs, one JSONL file per run.
+    Each line is written and synced to the disk as soon as the step completes, so that a run killed halfway
+    can be resumed from its last completed step.
+
+    @param path: directory to store the checkpoints
+    """
+
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, run_id: str) -> str:
+        return os.path.join(self.path, f"{run_id}.jsonl")
+
+    def append(self, run_id: str, step: CheckpointStep):
+        line = {
+            "id": step.id,
+            "thought": step.thought,
+            "command": step.command,
+            "input_variables": step.input_variables,
+            "inputs": [_variable_to_json(v) for v in step.inputs],
+            "outputs": step.outputs,
+            "error": step.error,
+            "observation": step.observation,
+            "variable": _variable_to_json(step.variable) if step.variable is not None else None,
+            "command_inputs": step.command_inputs,
+        }
+        with self._lock:
+            with open(self._file(run_id), "a", encoding="utf-8") as f:
+                f.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self, run_id: str) -> List[CheckpointStep]:
+        """
+        @return: the completed steps of the run in order, or an empty list if there is no checkpoint
+        """
+
+        if not os.path.exists(self._file(run_id)):
+            return []
+
+        steps: List[CheckpointStep] = []
+        with self._lock:
+            with open(self._file(run_id), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be cut off by a crash while writing
+                        break
+                    steps.append(
+                        CheckpointStep(
+                            id=data["id"],
+                            thought=data["thought"],
+                            command=data["command"],
+                            input_variables=data["input_variables"],
+                            inputs=[_variable_from_json(v) for v in data["inputs"]],
+                            outputs=data["outputs"],
+                            error=data["error"],
+                            observation=data["observation"],
+                            variable=_variable_from_json(data["variable"]) if data["variable"] is not None else None,
+                            command_inputs=data.get("command_inputs"),
+                        )
+                    )
+        return steps
+
+    def clear(self, run_id: str):
+        """
+        Remove the checkpoint of a finished run.
+        """
+
+        with self._lock:
+            if os.path.exists(self._file(run_id)):
+                os.remove(self._file(run_id))
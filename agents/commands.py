@@ -1,7 +1,17 @@
+from commands.binding import infer_bindings
 from commands.resolver import CommandResolver
 from commands.sequential import CommandStep, SequentialCommandStepCommand
 from langchain.llms.base import BaseLLM
-from agents.agent import AgentRun
+from commands.variables import materialize
+from agents.agent import AgentRun, AgentStep
+
+
+def _command_step(step: AgentStep) -> CommandStep:
+    bindings = None
+    if step.result.command_inputs is not None:
+        variables = [v._replace(value=materialize(v.value)) for v in step.result.inputs]
+        bindings = infer_bindings(step.result.command_inputs, variables)
+    return CommandStep(step.id, step.action.command, step.action.input_variables, bindings)
 
 
 def create_sequential_command_from_agent_run(
@@ -14,7 +24,7 @@ def create_sequential_command_from_agent_run(
         agent_run.task.text,
         {v.name: v.description for v in agent_run.task.input_variables},
         {f.name: f.schema.string() for f in agent_run.task.output_schema.fields},
-        list(map(lambda step: CommandStep(step.id, step.action.command, step.action.input_variables), steps)),
+        list(map(_command_step, steps)),
         command_llm,
         command_resolver,
     )
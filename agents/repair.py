@@ -0,0 +1,149 @@
+import ast
+import difflib
+import json
+import re
+from typing import List, Optional, Tuple
+
+# Labels the planning LLM tends to use instead of the ones in the prompt
+COMMAND_LABELS = ["Command", "Action", "Tool"]
+INPUT_VARIABLES_LABELS = ["Input variables", "Input variable", "Input vars", "Inputs", "Input", "Variables"]
+
+# A name referring to the output of a step, like "steps.0.output" or "step 0"
+STEP_OUTPUT = re.compile(r"^steps?\W*(\d+)\b", re.IGNORECASE)
+
+
+def _name_key(name: str) -> str:
+    """
+    @return: the name in lowercase words without plurals, like "search notion database command"
+    """
+
+    name = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", name)
+    words = []
+    for word in re.findall(r"[a-z0-9]+", name.lower()):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return " ".join(words)
+
+
+def match_name(name: str, candidates: List[str]) -> Optional[str]:
+    """
+    Find the candidate meant by a name written differently, like "SearchNotionDatabaseCommand" or "`text`".
+    Only the case, quotes, punctuation and plurals may differ: a misspelled name is not matched,
+    as the closest name may be another command, like InsertNotionDatabasePageCommand for a delete.
+
+    @param name: name written by the LLM
+    @param candidates: valid names
+    @return: the matched candidate, or None if no candidate or more than one is written the same way
+    """
+
+    name = name.strip().strip("`'\".,:;()[]{}<>").strip()
+    if name in candidates:
+        return name
+
+    matches = [c for c in candidates if _name_key(c) == _name_key(name)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def match_variable(name: str, candidates: List[str]) -> Optional[str]:
+    """
+    Find the variable meant by a name written by the LLM, like "steps.0.output" for "steps.0.output.url",
+    or a task variable for its misspelled name.
+    The output of a step is only matched by the same step number, as another step's output is different data.
+
+    @param name: name written by the LLM
+    @param candidates: valid variable names
+    @return: the matched variable name, or None if nothing matches
+    """
+
+    name = name.strip().strip("`'\".,:;()[]{}<>").strip()
+    if name in candidates:
+        return name
+
+    prefixed = next((c for c in candidates if name.startswith(c + ".")), None)
+    if prefixed is not None:
+        return prefixed
+
+    step = STEP_OUTPUT.match(name)
+    if step is not None:
+        output = f"steps.{step.group(1)}.output"
+        return output if output in candidates else None
+
+    # A misspelled task variable only selects data given to the task, so that it's matched by similarity
+    task_variables = [c for c in candidates if not STEP_OUTPUT.match(c)]
+    matched = match_name(name, task_variables)
+    if matched is not None:
+        return matched
+    matches = difflib.get_close_matches(name.lower(), [c.lower() for c in task_variables], n=1, cutoff=0.8)
+    return next((c for c in task_variables if len(matches) > 0 and c.lower() == matches[0]), None)
+
+
+def parse_variable_list(text: str) -> List[str]:
+    """
+    Decode a list of variable names written in any of JSON, Python or bare comma separated forms,
+    like '["text", "steps.0.output"]', "['text']" or "text, steps.0.output".
+    """
+
+    text = text.strip().splitlines()[0].strip() if text.strip() != "" else ""
+
+    for parse in [json.loads, ast.literal_eval]:
+        try:
+            value = parse(text)
+        except Exception:
+            continue
+        if isinstance(value, (list, tuple)):
+            return [str(v) for v in value]
+        if isinstance(value, str):
+            return [value]
+
+    names = [s.strip().strip("`'\"").strip() for s in text.strip("[]").split(",")]
+    return [n for n in names if n != ""]
+
+
+def _find_labeled(output: str, labels: List[str]) -> Optional[re.Match]:
+    pattern = r"^[ \t]*(?:\d+\.\s*)?(?:" + "|".join(map(re.escape, labels)) + r")[ \t]*[:=][ \t]*(.*)$"
+    return re.search(pattern, output, re.IGNORECASE | re.MULTILINE)
+
+
+def repair_action(output: str, command_names: List[str]) -> Optional[Tuple[str, str, List[str]]]:
+    """
+    Parse a planning output which does not follow the format exactly,
+    tolerating alternative or missing labels and misspelled command names.
+
+    @param output: output of the planning LLM
+    @param command_names: names of the available commands
+    @return: (thought, command, input variables as written), or None if the output can't be recovered
+    """
+
+    command_match = _find_labeled(output, COMMAND_LABELS)
+    if command_match:
+        command = match_name(command_match.group(1), command_names)
+        rest = output[command_match.end() :]
+        thought_end = command_match.start()
+    else:
+        # The label is missing: take the first line mentioning a command
+        command, rest, thought_end = None, "", 0
+        for line_match in re.finditer(r"^.*$", output, re.MULTILINE):
+            for word in re.findall(r"[A-Za-z_][\w]*", line_match.group(0)):
+                if word in command_names:
+                    command, rest, thought_end = word, output[line_match.end() :], line_match.end()
+                    break
+            if command is not None:
+                break
+
+    if command is None:
+        return None
+
+    inputs_match = _find_labeled(rest, INPUT_VARIABLES_LABELS)
+    if inputs_match:
+        input_variables = parse_variable_list(inputs_match.group(1))
+    else:
+        # The label is missing: take the next non-empty line if it looks like a list
+        lines = [line.strip() for line in rest.splitlines() if line.strip() != ""]
+        if len(lines) == 0 or not lines[0].startswith("["):
+            # Guessing no inputs would run the command on an input made up by the LLM
+            return None
+        input_variables = parse_variable_list(lines[0])
+
+    thought = re.sub(r"^\s*Thought:\s*", "", output[:thought_end], flags=re.IGNORECASE).strip()
+    return thought, command, input_variables
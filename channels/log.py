@@ -0,0 +1,43 @@
+import json
+import sys
+from typing import Any, TextIO
+from channels.channel import Channel
+
+
+class ChannelLog(Channel):
+    """
+    A non-interactive channel writing the messages to a stream, like for batch runs.
+    Human checks are answered with a fixed reply instead of reading from stdin.
+
+    @param reply: reply to every human check, like "OK" to approve every input
+    @param stream: stream to write the messages to (stderr by default)
+    """
+
+    REJECT = "Rejected: no human is available to check the input"
+
+    reply: str
+    stream: TextIO
+
+    def __init__(self, reply: str = REJECT, stream: TextIO = sys.stderr):
+        self.reply = reply
+        self.stream = stream
+
+    def _write(self, message: str, data: Any):
+        lines = [
+            "",
+            message,
+        ]
+
+        if data != {}:
+            lines.append("")
+            lines.append(json.dumps(data, indent=2, ensure_ascii=False))
+
+        print("\n".join(lines), file=self.stream, flush=True)
+
+    async def send(self, message: str, data: Any = {}):
+        self._write(message, data)
+
+    async def wait_reply(self, message: str, data: Any = {}) -> str:
+        self._write(message, data)
+        self._write(f"Reply: {self.reply}", {})
+        return self.reply
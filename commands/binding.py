@@ -0,0 +1,112 @@
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from commands.command import Variable
+from commands.variables import materialize
+
+# A binding copies the value at a source path to a target path of the command input,
+# where the source path starts with a variable name followed by object keys,
+# like (["page", "title"], ["steps.0.output", "title"]). An empty target path binds the whole input.
+Binding = Tuple[List[str], List[str]]
+
+# Object keys deeper than this are not searched for the values of the input
+MAX_DEPTH = 4
+
+# Strings shorter than this are bound only from the same key, as they are found in the variables by chance
+MIN_STRING_LENGTH = 4
+# Numbers smaller than this are bound only from the same key, for the same reason
+MIN_NUMBER = 1000
+
+
+def _key(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _index(value: Any, path: List[str], depth: int, index: Dict[str, List[List[str]]]):
+    index.setdefault(_key(value), []).append(path)
+    if isinstance(value, dict) and depth < MAX_DEPTH:
+        for k, v in value.items():
+            _index(v, path + [str(k)], depth + 1, index)
+
+
+def _coincidental(value: Any) -> bool:
+    """
+    Whether the value is likely to be found in the variables by chance, like a limit of 1 written by the LLM.
+    """
+
+    if value is None or isinstance(value, bool):
+        return True
+    if isinstance(value, (int, float)):
+        return abs(value) < MIN_NUMBER
+    if isinstance(value, str):
+        return len(value.strip()) < MIN_STRING_LENGTH
+    if isinstance(value, (list, dict)):
+        return len(value) == 0
+    return False
+
+
+def _pick(paths: List[List[str]], target: List[str], value: Any) -> Optional[List[str]]:
+    if len(paths) == 1 and not _coincidental(value):
+        return paths[0]
+    # The same value is found in several places, or may be found by chance: trust only the one named like the target
+    named = [p for p in paths if len(target) > 0 and p[-1] == target[-1]]
+    return named[0] if len(named) == 1 else None
+
+
+def infer_bindings(inputs: Any, variables: List[Variable]) -> Optional[List[Binding]]:
+    """
+    Infer how the input of a command was built from the variables, by finding each value of the input
+    in the variables. Objects are bound key by key, other values only as a whole.
+
+    @param inputs: the input the command received in a successful run
+    @param variables: the variables the input was built from, with the full values
+    @return: the bindings rebuilding the input from the variables, or None if some value is not found in them
+        (like a text written by the LLM), or is a short value like 1 or true found under another key
+    """
+
+    index: Dict[str, List[List[str]]] = {}
+    for v in variables:
+        _index(v.value, [v.name], 0, index)
+
+    bindings: List[Binding] = []
+
+    def bind(value: Any, target: List[str]) -> bool:
+        source = _pick(index.get(_key(value), []), target, value)
+        if source is not None:
+            bindings.append((target, source))
+            return True
+        if isinstance(value, dict) and len(value) > 0:
+            return all(bind(v, target + [str(k)]) for k, v in value.items())
+        return False
+
+    return bindings if bind(inputs, []) else None
+
+
+def apply_bindings(bindings: Sequence[Binding], variables: List[Variable]) -> Optional[Any]:
+    """
+    Build the input of a command from the variables by the bindings.
+
+    @return: the input, or None if a source path is not found in the variables
+    """
+
+    values = {v.name: v.value for v in variables}
+    inputs: Any = None
+    for target, source in bindings:
+        if len(source) == 0 or source[0] not in values:
+            return None
+        value = materialize(values[source[0]])
+        for k in source[1:]:
+            if not isinstance(value, dict) or k not in value:
+                return None
+            value = value[k]
+
+        if len(target) == 0:
+            inputs = value
+            continue
+        if inputs is None:
+            inputs = {}
+        node = inputs
+        for k in target[:-1]:
+            node = node.setdefault(k, {})
+        node[target[-1]] = value
+    return inputs
@@ -1,9 +1,11 @@
 import abc
-from typing import Any, List, NamedTuple, Tuple
+import asyncio
+from typing import Any, List, NamedTuple, Optional, Tuple, Type
 from commands.data_schema import (
     DataSchemaDict,
 )
 from channels.channel import Channel
+from utils.tracing import span
 
 
 class Command(metaclass=abc.ABCMeta):
@@ -12,10 +14,25 @@ class Command(metaclass=abc.ABCMeta):
 
     @param human_check: whether the command requires human check
     @param additional_prompts: additional prompts for executing the command
+
+    The following policy is enforced by CommandExecuter on each execution, after the human check:
+    @param timeout: seconds to wait for an attempt, or None to wait forever
+    @param max_retries: maximum number of retries after a failed attempt raising one of retryable_errors
+    @param backoff: seconds to wait before the first retry, doubled on each retry
+    @param retryable_errors: exception classes worth retrying, like network errors (see also is_retryable)
+    @param circuit_failure_threshold: number of consecutive failed attempts to stop executing the command
+        for circuit_reset_timeout seconds, failing fast instead (None to disable)
+    @param circuit_reset_timeout: seconds to fail fast before trying the command again
     """
 
     human_check: bool
     additional_prompts: List[str] = []
+    timeout: Optional[float] = None
+    max_retries: int = 0
+    backoff: float = 1.0
+    retryable_errors: Tuple[Type[Exception], ...] = (asyncio.TimeoutError, ConnectionError)
+    circuit_failure_threshold: Optional[int] = None
+    circuit_reset_timeout: float = 30.0
 
     def __init__(
         self,
@@ -55,10 +72,30 @@ class Command(metaclass=abc.ABCMeta):
         Run the command, validating the input and output based on the schema.
         """
 
-        error = self.input_schema.validate(inputs)
+        error = await self.check(inputs, channel)
         if error:
             return None, error
 
+        return await self.run_checked(inputs, channel)
+
+    def is_retryable(self, error: Exception) -> bool:
+        """
+        Whether a failed attempt is worth retrying. Override this to judge by the details, like an HTTP status.
+        """
+
+        return isinstance(error, self.retryable_errors)
+
+    async def check(self, inputs: Any, channel: Channel) -> str:
+        """
+        Validate the input, and ask the user to check it if required.
+
+        @return: error message if the input is rejected, otherwise empty string
+        """
+
+        error = self.input_schema.validate(inputs)
+        if error:
+            return error
+
         if self.human_check:
             reply = await channel.wait_reply(
                 "Enter 'OK' if the input looks good, otherwise put the reason"
@@ -70,9 +107,18 @@ class Command(metaclass=abc.ABCMeta):
             )
 
             if reply != "OK":
-                return None, reply
+                return reply
+
+        return ""
+
+    async def run_checked(self, inputs: Any, channel: Channel) -> Tuple[Any, str]:
+        """
+        Run the command on the input passed check(), validating the output.
+        """
 
-        outputs, error = await self._run(inputs, channel)
+        with span("command.run", command=self.name) as s:
+            outputs, error = await self._run(inputs, channel)
+            s.set_error(error)
         if error:
             return None, error
 
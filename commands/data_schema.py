@@ -1,4 +1,5 @@
 import abc
+import re
 from typing import Any, List, NamedTuple
 
 
@@ -18,6 +19,15 @@ class DataSchema(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError()
 
+    def repair(self, data: Any) -> Any:
+        """
+        Fix obvious mistakes in the data, like a number given as a string or a missing empty array.
+
+        @param data: data which may not satisfy the schema
+        @return: the fixed data, which still needs to be validated
+        """
+        return data
+
 
 class DataSchemaScalar(DataSchema):
     description: str
@@ -37,6 +47,16 @@ class DataSchemaScalar(DataSchema):
             return "" if type(data) is int else "should be int"
         raise NotImplementedError()
 
+    def repair(self, data: Any) -> Any:
+        if self.python_type == "str" and type(data) in (int, float):
+            return str(data)
+        if self.python_type == "int":
+            if type(data) is str and re.fullmatch(r"\s*-?\d+\s*", data):
+                return int(data)
+            if type(data) is float and data.is_integer():
+                return int(data)
+        return data
+
 
 class DataSchemaEnum(DataSchema):
     description: str
@@ -54,6 +74,15 @@ class DataSchemaEnum(DataSchema):
             return f"should be one of [{','.join(self.values)}]"
         return ""
 
+    def repair(self, data: Any) -> Any:
+        if data is None and len(self.values) == 1:
+            return self.values[0]
+        if type(data) is str:
+            for value in self.values:
+                if type(value) is str and value.lower() == data.strip().lower():
+                    return value
+        return data
+
 
 class DataSchemaArray(DataSchema):
     schema: DataSchema
@@ -73,6 +102,13 @@ class DataSchemaArray(DataSchema):
                 return error
         return ""
 
+    def repair(self, data: Any) -> Any:
+        if data is None:
+            return []
+        if type(data) is not list:
+            data = [data]
+        return [self.schema.repair(item) for item in data]
+
 
 class DataSchemaField(NamedTuple):
     name: str
@@ -96,3 +132,11 @@ class DataSchemaDict(DataSchema):
             if error:
                 return f"field {field.name}: {error}"
         return ""
+
+    def repair(self, data: Any) -> Any:
+        if data is None:
+            data = {}
+        if type(data) is not dict:
+            return data
+        # Unknown keys are dropped
+        return {field.name: field.schema.repair(data.get(field.name)) for field in self.fields}
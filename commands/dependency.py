@@ -0,0 +1,72 @@
+import threading
+from typing import Dict, Iterable, List, Set
+from commands.command import RETURN_COMMAND_NAME, Command
+from commands.composite import CompositeCommand
+
+
+def command_dependencies(command: Command) -> List[str]:
+    """
+    @return: names of the commands which the given command executes, built from its serialized form
+    """
+
+    if not isinstance(command, CompositeCommand):
+        return []
+
+    steps = command.to_json().get("steps", [])
+    return list(dict.fromkeys(s["command"] for s in steps if s["command"] != RETURN_COMMAND_NAME))
+
+
+class DependencyGraph:
+    """
+    A directed graph from each command to the commands it executes.
+    """
+
+    def __init__(self):
+        self._dependencies: Dict[str, Set[str]] = {}
+        self._dependents: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, command: str) -> bool:
+        return command in self._dependencies
+
+    def set(self, command: str, dependencies: Iterable[str]):
+        """
+        Set the direct dependencies of a command, replacing the previous ones.
+        """
+
+        with self._lock:
+            for d in self._dependencies.get(command, set()):
+                self._dependents[d].discard(command)
+            self._dependencies[command] = set(dependencies)
+            for d in self._dependencies[command]:
+                self._dependents.setdefault(d, set()).add(command)
+
+    def dependencies(self, command: str) -> Set[str]:
+        with self._lock:
+            return set(self._dependencies.get(command, set()))
+
+    def closure(self, commands: Iterable[str]) -> Set[str]:
+        """
+        @return: the given commands and all the commands they depend on transitively, as far as known
+        """
+
+        return self._traverse(commands, self._dependencies)
+
+    def dependents(self, commands: Iterable[str]) -> Set[str]:
+        """
+        @return: the given commands and all the commands depending on them transitively
+        """
+
+        return self._traverse(commands, self._dependents)
+
+    def _traverse(self, commands: Iterable[str], edges: Dict[str, Set[str]]) -> Set[str]:
+        with self._lock:
+            visited: Set[str] = set()
+            stack = list(commands)
+            while len(stack) > 0:
+                command = stack.pop()
+                if command in visited:
+                    continue
+                visited.add(command)
+                stack.extend(edges.get(command, set()) - visited)
+            return visited
@@ -1,13 +1,75 @@
+import asyncio
 import json
-from typing import Any, Tuple, List
+import threading
+import weakref
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, List
+from commands.binding import Binding, apply_bindings
 from commands.command import Command, Variable
+from commands.data_schema import DataSchema, DataSchemaArray, DataSchemaDict
+from commands.policy import run_with_policy
+from commands.variables import REF_PREFIX, SpilledValue, materialize, preview_value, resolve_refs
 from langchain import LLMChain, PromptTemplate
 from langchain.llms.base import BaseLLM
 from channels.channel import Channel
+from utils.json_repair import extract_json
+from utils.llm import CompletionCache, arun_chain
+from utils.metrics import Metrics
+from utils.tracing import current_span, traced
+
+
+def _is_object(value: Any) -> bool:
+    if isinstance(value, SpilledValue):
+        return value.preview.lstrip().startswith("{")
+    return isinstance(value, dict)
+
+
+def _may_satisfy(schema: DataSchema, value: Any) -> bool:
+    """
+    Whether a value can satisfy the schema, judging a spilled value only by its shape to avoid loading it.
+    """
+
+    if not isinstance(value, SpilledValue):
+        return schema.validate(value) == ""
+
+    start = value.preview.lstrip()[:1]
+    if isinstance(schema, DataSchemaDict):
+        return start == "{"
+    if isinstance(schema, DataSchemaArray):
+        return start == "["
+    return start not in ("{", "[")
 
 
 class CommandExecuter:
+    """
+    Executes a command by transforming the given variables into its input with the LLM.
+
+    Values longer than max_inline_chars are put into the prompt truncated, along with a reference
+    like "$ref:steps.0.output" the LLM can write in place of the value. The references are replaced
+    with the full values before the command runs.
+
+    When the input can be built from the variables without ambiguity, by the field names or a value
+    already satisfying the input schema, the LLM is not called at all. The calls made and avoided are counted
+    in metrics as executor_llm_calls and executor_bindings.
+
+    The JSON in the LLM output is extracted tolerating code fences, prose and syntax mistakes,
+    and fixed by the input schema if it doesn't satisfy it. Only if that fails, the LLM is asked once
+    to fix the output with the validation error.
+
+    @param max_inline_chars: maximum number of characters of a value in the prompt (None for no limit)
+    @param bind_inputs: whether to try binding the input without the LLM
+    @param completion_cache: the cache of the completions (None to disable)
+    @param llm_timeout: seconds to wait for an LLM call, or None to wait forever
+
+    The command runs under its own policy (timeout, retries and circuit breaker, see Command),
+    counted as command_timeouts, command_retries and command_circuit_open.
+    """
+
     llm_chain: LLMChain
+    metrics: Metrics
+    max_inline_chars: Optional[int] = 4000
+    bind_inputs: bool = True
+    completion_cache: Optional[CompletionCache] = None
+    llm_timeout: Optional[float] = None
 
     PROMPT = """
 Your task is to transform the given context into the desired data format.
@@ -20,27 +82,240 @@ Format:
 
 Output should only contain the output, with the format of JSON which satisfies the format above.
 
+Output:
+"""
+
+    REPAIR_PROMPT = """
+Your task is to transform the given context into the desired data format.
+
+Context:
+{context}
+
+Format:
+{format}
+
+Your previous output was invalid.
+
+Previous output:
+{output}
+
+Error:
+{error}
+
+Fix the output. Output should only contain the output, with the format of JSON which satisfies the format above.
+
 Output:
 """
 
     def __init__(self, llm: BaseLLM, verbose: bool = False):
         prompt = PromptTemplate(template=self.PROMPT, input_variables=["context", "format"])
         self.llm_chain = LLMChain(llm=llm, prompt=prompt, verbose=verbose)
+        repair_prompt = PromptTemplate(
+            template=self.REPAIR_PROMPT, input_variables=["context", "format", "output", "error"]
+        )
+        self.repair_chain = LLMChain(llm=llm, prompt=repair_prompt, verbose=verbose)
+        self.metrics = Metrics()
+
+        # Rendered input formats, kept as long as the commands are alive
+        self._formats: "weakref.WeakKeyDictionary[Command, str]" = weakref.WeakKeyDictionary()
+        self._formats_lock = threading.Lock()
 
-    async def execute(self, command: Command, variables: List[Variable], channel: Channel) -> Tuple[Any, str]:
-        context = "\n\n".join(map(lambda v: f"{v.description}: {json.dumps(v.value, ensure_ascii=False)}", variables))
-        format = command.input_schema.string()
-        if len(command.additional_prompts) > 0:
-            format += "\n\nAdditional prompts:" + "\n".join(command.additional_prompts)
+    def prepare(self, command: Command) -> str:
+        """
+        Render the input format of the command ahead of its execution.
+        This is safe to call from any thread.
 
+        @return: the input format for the prompt
+        """
+
+        with self._formats_lock:
+            format = self._formats.get(command)
+        if format is None:
+            format = command.input_schema.string()
+            if len(command.additional_prompts) > 0:
+                format += "\n\nAdditional prompts:" + "\n".join(command.additional_prompts)
+            with self._formats_lock:
+                self._formats[command] = format
+        return format
+
+    def _render_variable(self, variable: Variable) -> str:
+        if self.max_inline_chars is not None:
+            preview = preview_value(variable.value, self.max_inline_chars)
+            if preview is not None:
+                ref = json.dumps(REF_PREFIX + variable.name)
+                return f"{variable.description} (truncated, write {ref} to use the whole value): {preview}"
+        return f"{variable.description}: {json.dumps(materialize(variable.value), ensure_ascii=False)}"
+
+    async def _parse_inputs(
+        self,
+        command: Command,
+        variables: List[Variable],
+        output: str,
+        context: str,
+        format: str,
+        count: Callable[[str], None],
+    ) -> Any:
+        """
+        Parse the LLM output into the input of the command, repairing it locally if needed,
+        and asking the LLM to fix it as the last resort.
+
+        @return: the input, which may still not satisfy the input schema
+        """
+
+        schema = command.input_schema
+        refs = {v.name: v for v in variables}
         try:
-            llm_result = self.llm_chain.run(context=context, format=format)
-            inputs = json.loads(llm_result)
+            inputs = resolve_refs(extract_json(output), refs)
+            error = schema.validate(inputs)
+            if error == "":
+                return inputs
+
+            repaired = schema.repair(inputs)
+            if schema.validate(repaired) == "":
+                count("executor_schema_repairs")
+                return repaired
+        except (ValueError, TypeError) as e:
+            error = str(e)
+
+        count("executor_repair_prompts")
+        output = await asyncio.wait_for(
+            arun_chain(
+                self.repair_chain,
+                completion_cache=self.completion_cache,
+                context=context,
+                format=format,
+                output=output,
+                error=error,
+            ),
+            self.llm_timeout,
+        )
+        inputs = resolve_refs(extract_json(output), refs)
+        return inputs if schema.validate(inputs) == "" else schema.repair(inputs)
+
+    def bind(self, command: Command, variables: List[Variable]) -> Optional[Any]:
+        """
+        Build the input of the command from the variables without the LLM, the first found of
+        - an object taking every field from the variable of the same name,
+        - the value of the only variable satisfying the input schema, or
+        - an object taking each field from the variable of the same name,
+          or from the same key of the only object variable having it.
+
+        Spilled values are loaded only if chosen by name, if their shape can satisfy the schema,
+        or if they are objects and no variable has the name of a field.
+
+        @return: the input satisfying the input schema, or None if it can't be built unambiguously
+        """
+
+        schema = command.input_schema
+        loaded: Dict[str, Any] = {}
+
+        def value(v: Variable) -> Any:
+            if v.name not in loaded:
+                loaded[v.name] = materialize(v.value)
+            return loaded[v.name]
+
+        if isinstance(schema, DataSchemaDict) and len(schema.fields) > 0:
+            named = [[v for v in variables if v.name == field.name] for field in schema.fields]
+            if all(len(n) == 1 for n in named):
+                inputs = {field.name: value(n[0]) for field, n in zip(schema.fields, named)}
+                if schema.validate(inputs) == "":
+                    return inputs
+
+        matches = [value(v) for v in variables if _may_satisfy(schema, v.value) and schema.validate(value(v)) == ""]
+        if len(matches) > 1 or (len(matches) == 0 and not isinstance(schema, DataSchemaDict)):
+            return None
+        if len(matches) == 1:
+            if isinstance(schema, DataSchemaDict):
+                # Drop the keys not in the schema, as the LLM would do
+                return {field.name: matches[0][field.name] for field in schema.fields}
+            return matches[0]
 
-            outputs, error = await command.run(inputs, channel)
+        inputs = {}
+        for field in schema.fields:
+            candidates = [value(v) for v in variables if v.name == field.name]
+            if len(candidates) == 0:
+                objects = [value(v) for v in variables if _is_object(v.value)]
+                candidates = [o[field.name] for o in objects if isinstance(o, dict) and field.name in o]
+            if len(candidates) != 1 or field.schema.validate(candidates[0]) != "":
+                return None
+            inputs[field.name] = candidates[0]
+        return inputs
+
+    async def execute(
+        self, command: Command, variables: List[Variable], channel: Channel, metrics: Optional[Metrics] = None
+    ) -> Tuple[Any, str]:
+        """
+        Execute the command with the input built from the variables.
+
+        @param metrics: metrics of the run to count the LLM calls in, besides the metrics of the executor
+        @return: (output, error)
+        """
+
+        _, outputs, error = await self.execute_with_inputs(command, variables, channel, metrics)
+        return outputs, error
+
+    @traced("executor.execute", on_result=lambda s, result: s.set_error(result[2]))
+    async def execute_with_inputs(
+        self,
+        command: Command,
+        variables: List[Variable],
+        channel: Channel,
+        metrics: Optional[Metrics] = None,
+        bindings: Optional[Sequence[Binding]] = None,
+    ) -> Tuple[Any, Any, str]:
+        """
+        Execute the command with the input built from the variables, returning the input as well.
+
+        @param metrics: metrics of the run to count the LLM calls in, besides the metrics of the executor
+        @param bindings: bindings learned from a previous run to build the input with, falling back to
+            the other ways if the result doesn't satisfy the input schema
+        @return: (input, output, error), where input is None if it couldn't be built
+        """
+
+        trace = current_span()
+        trace.set("command", command.name)
+
+        def count(name: str):
+            self.metrics.increment(name)
+            if metrics is not None:
+                metrics.increment(name)
+            trace.set(name, trace.attributes.get(name, 0) + 1)
+
+        inputs = None
+        try:
+            if bindings is not None:
+                inputs = apply_bindings(bindings, variables)
+                if inputs is not None and command.input_schema.validate(inputs) == "":
+                    count("executor_learned_bindings")
+                else:
+                    inputs = None
+                    count("executor_learned_binding_failures")
+
+            if inputs is None and self.bind_inputs:
+                inputs = self.bind(command, variables)
+                if inputs is not None:
+                    count("executor_bindings")
+
+            if inputs is None:
+                count("executor_llm_calls")
+                context = "\n\n".join(map(self._render_variable, variables))
+                format = self.prepare(command)
+                llm_result = await asyncio.wait_for(
+                    arun_chain(self.llm_chain, completion_cache=self.completion_cache, context=context, format=format),
+                    self.llm_timeout,
+                )
+                inputs = await self._parse_inputs(command, variables, llm_result, context, format, count)
+
+            # The policy of the command applies to the execution only, not to the human check
+            error = await command.check(inputs, channel)
+            if error != "":
+                return inputs, None, error
+            outputs, error = await run_with_policy(command, inputs, channel, count)
             if error != "":
-                return None, error
+                return inputs, None, error
+        except asyncio.TimeoutError as e:
+            return inputs, None, str(e) or f"{command.name} timed out"
         except Exception as e:
-            return None, str(e)
+            return inputs, None, str(e) or type(e).__name__
 
-        return outputs, ""
+        return inputs, outputs, ""
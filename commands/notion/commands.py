@@ -1,3 +1,5 @@
+import asyncio
+import functools
 from typing import Any, Dict, List, Tuple
 from commands.command import Command
 from commands.data_schema import (
@@ -7,10 +9,25 @@ from commands.data_schema import (
     DataSchemaField,
     DataSchemaScalar,
 )
+from httpx import TransportError
 from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
 from channels.channel import Channel
 from utils.string import parse_comma_separated_text
 
+NOTION_RETRYABLE_ERRORS = (asyncio.TimeoutError, ConnectionError, TransportError, RequestTimeoutError)
+
+
+def is_notion_retryable(error: Exception) -> bool:
+    """
+    Whether a failed Notion API call is transient: a network error, or a response rate limited (429) or failed
+    by the server (5xx), including the API errors like service_unavailable.
+    """
+
+    if isinstance(error, HTTPResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, NOTION_RETRYABLE_ERRORS)
+
 
 def notion_commands(token: str) -> List[Command]:
     return [
@@ -25,6 +42,14 @@ class SearchNotionDatabasesCommand(Command):
     description: str = "Search Notion databases and return the database schema"
     token: str
 
+    timeout = 30.0
+    max_retries = 2
+    retryable_errors = NOTION_RETRYABLE_ERRORS
+    circuit_failure_threshold = 5
+
+    def is_retryable(self, error: Exception) -> bool:
+        return is_notion_retryable(error)
+
     input_schema: DataSchemaDict = DataSchemaDict(
         [
             DataSchemaField("database_name", DataSchemaScalar("name of the database to search", "str")),
@@ -62,11 +87,16 @@ class SearchNotionDatabasesCommand(Command):
         database_name = inputs["database_name"]
 
         notion = Client(auth=self.token)
-        response: Any = notion.search(
-            **{
-                "query": database_name,
-                "filter": {"value": "database", "property": "object"},
-            }
+        # The client blocks, so that it runs in a thread not to block the event loop (and the timeout)
+        response: Any = await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                notion.search,
+                **{
+                    "query": database_name,
+                    "filter": {"value": "database", "property": "object"},
+                },
+            ),
         )
 
         # For simplicity, returns the first matched one
@@ -92,6 +122,10 @@ class InsertNotionDatabasePageCommand(Command):
     name: str = "InsertNotionDatabasePageCommand"
     description: str = "Insert a new page to a Notion database"
     token: str
+
+    # Neither retried nor timed out, as the page could be inserted twice: giving up waiting doesn't stop the call,
+    # which can still insert the page after the error is reported. The Notion client times out requests by itself.
+    circuit_failure_threshold = 5
     additional_prompts: List[str] = [
         "Be sure to set the proper values to 'properties' fields, which should be inferred from the content.",
         "The value of 'multi_select' property should be a list of strings, separated by comma. For example, 'a,b,c'.",
@@ -209,26 +243,30 @@ class InsertNotionDatabasePageCommand(Command):
                 pass
 
         notion = Client(auth=self.token)
-        response: Any = notion.pages.create(
-            **{
-                "parent": {"database_id": schema["id"]},
-                "properties": properties,
-                "children": [
-                    {
-                        "object": "block",
-                        "type": "paragraph",
-                        "paragraph": {
-                            "rich_text": [
-                                {
-                                    "type": "text",
-                                    "text": {
-                                        "content": page["content"],
-                                    },
-                                }
-                            ]
+        response: Any = await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                notion.pages.create,
+                **{
+                    "parent": {"database_id": schema["id"]},
+                    "properties": properties,
+                    "children": [
+                        {
+                            "object": "block",
+                            "type": "paragraph",
+                            "paragraph": {
+                                "rich_text": [
+                                    {
+                                        "type": "text",
+                                        "text": {
+                                            "content": page["content"],
+                                        },
+                                    }
+                                ]
+                            },
                         },
-                    },
-                ],
-            }
+                    ],
+                },
+            ),
         )
         return {"url": response["url"]}, ""
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+import weakref
+from typing import Any, Callable, Optional, Tuple
+
+from channels.channel import Channel
+from commands.command import Command
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while, failing fast instead.
+
+    The circuit opens after failure_threshold consecutive failures. Once reset_timeout seconds pass,
+    one call is let through to probe the dependency: the circuit closes if it succeeds, otherwise opens again.
+
+    @param failure_threshold: number of consecutive failures to open the circuit
+    @param reset_timeout: seconds to keep the circuit open
+    """
+
+    failure_threshold: int
+    reset_timeout: float
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        @return: whether a call can be made now
+        """
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        """
+        Record a call ending without a result, like cancelled, so that another call can probe instead.
+        """
+
+        with self._lock:
+            self._probing = False
+
+
+# Circuit breakers shared by all the executions of a command, kept as long as the command is alive
+_breakers: "weakref.WeakKeyDictionary[Command, CircuitBreaker]" = weakref.WeakKeyDictionary()
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(command: Command) -> Optional[CircuitBreaker]:
+    """
+    @return: the circuit breaker of the command, or None if disabled
+    """
+
+    if command.circuit_failure_threshold is None:
+        return None
+
+    with _breakers_lock:
+        breaker = _breakers.get(command)
+        if breaker is None:
+            breaker = CircuitBreaker(command.circuit_failure_threshold, command.circuit_reset_timeout)
+            _breakers[command] = breaker
+        return breaker
+
+
+async def run_with_policy(
+    command: Command, inputs: Any, channel: Channel, count: Callable[[str], None] = lambda name: None
+) -> Tuple[Any, str]:
+    """
+    Run a command on the checked input, enforcing its timeout, retries and circuit breaker.
+    Only exceptions (including timeouts) are failures here: errors returned by the command are its results.
+
+    @param count: called with the name of each event, like "command_retries"
+    @return: (output, error)
+    """
+
+    breaker = circuit_breaker(command)
+
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow():
+            count("command_circuit_open")
+            return None, f"{command.name} is failing repeatedly, skipped for a while. Try another command."
+
+        try:
+            result = await asyncio.wait_for(command.run_checked(inputs, channel), command.timeout)
+        except Exception as e:
+            if breaker is not None:
+                breaker.record_failure()
+            if isinstance(e, asyncio.TimeoutError):
+                count("command_timeouts")
+                e = asyncio.TimeoutError(f"{command.name} timed out after {command.timeout} seconds")
+
+            if not command.is_retryable(e) or attempt >= command.max_retries:
+                raise e
+
+            count("command_retries")
+            await asyncio.sleep(command.backoff * 2**attempt)
+            attempt += 1
+            continue
+        except BaseException:
+            # Like cancelled: let another call probe, otherwise the circuit would stay open for good
+            if breaker is not None:
+                breaker.release()
+            raise
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
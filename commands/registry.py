@@ -1,11 +1,47 @@
+import hashlib
 import json
-from typing import Dict, Optional, List
+from typing import Dict, NamedTuple, Optional, List, Set, Tuple
 from commands.command import Command
 from commands.composite import CompositeCommand
+from commands.dependency import DependencyGraph, command_dependencies
 from commands.resolver import CommandResolver
 from commands.sequential import SequentialCommandStepCommand
 from langchain.llms.base import BaseLLM
+from storage.lexical import LexicalHit, LexicalIndex
 from storage.storage import Entry, Storage
+from utils.cache import LRUCache
+from utils.llm import CompletionCache
+from utils.tracing import current_span, traced
+
+
+def command_fingerprint(command: Command) -> str:
+    """
+    @return: hash of the command properties which its stored entry depends on
+    """
+
+    source = "\0".join(
+        [command.name, command.description, command.input_schema.string(), command.output_schema.string()]
+    )
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+class ScoredCommand(NamedTuple):
+    """
+    A command relevant to a query.
+
+    @param command: the command
+    @param score: relevance from 0 to 1
+    @param source: where the score comes from, SOURCE_VECTOR for the similarity of the embeddings,
+        or SOURCE_LEXICAL for the coverage of the query terms by the command name and description
+    """
+
+    command: Command
+    score: float
+    source: str
+
+
+SOURCE_VECTOR = "vector"
+SOURCE_LEXICAL = "lexical"
 
 
 class CommandRegistry(CommandResolver):
@@ -15,20 +51,80 @@ class CommandRegistry(CommandResolver):
     @param builtin_commands: list of builtin commands
     @param storage: storage to use for command persistence
     @param command_llm: LLM to be used for command execution
+    @param max_cached_commands: maximum number of parsed commands to keep in memory
+    @param max_cached_queries: maximum number of query results to keep in memory
+    @param query_cache_ttl: seconds to keep query results, or None to keep them until a command is saved
+    @param lexical_threshold: minimum coverage of the query terms by the best lexical match to skip the vector search,
+        which is only done if the storage can list all its entries to index them
+    @param completion_cache: cache of the completions for the stored commands parsed afterwards (None to disable)
     """
 
+    # Constant of the reciprocal rank fusion of lexical and vector rankings
+    RRF_K = 60
+
     builtin_commands: Dict[str, Command]
     storage: Storage
     command_llm: BaseLLM
+    lexical_threshold: float
+    dependency_graph: DependencyGraph
+    completion_cache: Optional[CompletionCache] = None
 
-    def __init__(self, builtin_commands: List[Command], storage: Storage, command_llm: BaseLLM):
+    def __init__(
+        self,
+        builtin_commands: List[Command],
+        storage: Storage,
+        command_llm: BaseLLM,
+        max_cached_commands: int = 1000,
+        max_cached_queries: int = 1000,
+        query_cache_ttl: Optional[float] = 600,
+        lexical_threshold: float = 0.9,
+    ):
         self.builtin_commands = {c.name: c for c in builtin_commands}
         self.storage = storage
         self.command_llm = command_llm
+        self.lexical_threshold = lexical_threshold
 
-        # Create or update entries for builtin commands
+        # Parsed commands with the stored body they were parsed from, keyed by name
+        self._commands: LRUCache[str, Tuple[str, Command]] = LRUCache(max_cached_commands)
+        # Query results keyed by (normalized query, n), cleared whenever a command is saved
+        self._queries: LRUCache[Tuple[str, int], List[ScoredCommand]] = LRUCache(
+            max_cached_queries, ttl=query_cache_ttl
+        )
+        # Names and descriptions of the commands seen so far, to skip the vector search when possible
+        self._lexical = LexicalIndex()
+        # Whether the lexical index holds every stored command, otherwise a lexical match may miss a better one
+        self._lexical_complete = False
+        # Which commands each composite command executes, to preload and invalidate them together
+        self.dependency_graph = DependencyGraph()
+
+        # Create or update entries only for the builtin commands changed since the last run
+        entries = {cmd.name: self._entry(cmd) for cmd in builtin_commands}
+        stored = self.storage.get_many(list(entries.keys()))
+        self.save_many([cmd for cmd in builtin_commands if stored.get(cmd.name) != entries[cmd.name]])
         for cmd in builtin_commands:
-            self.save(cmd)
+            self._cache(entries[cmd.name], cmd)
+        self._index_stored()
+
+    def _index_stored(self):
+        """
+        Add the stored composite commands to the lexical index without parsing them, if the storage can list them.
+        """
+
+        stored = self.storage.entries()
+        if stored is None:
+            return
+
+        for entry in stored:
+            try:
+                data = json.loads(entry.value)
+            except json.JSONDecodeError:
+                continue
+            if data.get("type") != "__builtin__" and "name" in data:
+                self._lexical.add(data["name"], f"{data['name']}\n{data.get('description', '')}")
+        self._lexical_complete = True
+
+    def _lexical_only(self, hits: List[LexicalHit]) -> bool:
+        return self._lexical_complete and len(hits) > 0 and hits[0].coverage >= self.lexical_threshold
 
     def parse_command(self, body: str) -> Optional[Command]:
         try:
@@ -36,33 +132,223 @@ class CommandRegistry(CommandResolver):
             if data["type"] == "__builtin__":
                 return self.builtin_commands[data["name"]]
             if data["type"] == "SequentialCommandStepCommand":
-                return SequentialCommandStepCommand.from_json(data, command_llm=self.command_llm, command_resolver=self)
+                command = SequentialCommandStepCommand.from_json(
+                    data, command_llm=self.command_llm, command_resolver=self
+                )
+                command.command_executor.completion_cache = self.completion_cache
+                return command
         except Exception as e:
             print(e)
             pass
 
         return None
 
-    def resolve(self, command: str) -> Optional[Command]:
-        entry = self.storage.get(command)
-        if entry is not None:
-            return self.parse_command(entry.value)
-        return None
+    def _parse_entry(self, entry: Entry) -> Optional[Command]:
+        cached = self._commands.get(entry.key)
+        if cached is not None and cached[0] == entry.value:
+            return cached[1]
 
-    def query(self, q: str, n: int) -> List[Command]:
+        command = self.parse_command(entry.value)
+        if command is not None:
+            self._cache(entry, command)
+        return command
+
+    def _cache(self, entry: Entry, command: Command):
+        self._commands.set(entry.key, (entry.value, command))
+        self._lexical.add(command.name, f"{command.name}\n{command.description}")
+        self.dependency_graph.set(command.name, command_dependencies(command))
+
+    def _resolve_cached(self, commands: List[str]) -> Tuple[Dict[str, Command], List[str]]:
+        resolved: Dict[str, Command] = {}
+        missing: List[str] = []
+        for name in dict.fromkeys(commands):
+            cached = self._commands.get(name)
+            if cached is not None:
+                resolved[name] = cached[1]
+            else:
+                missing.append(name)
+        return resolved, missing
+
+    def _parse_entries(self, entries: List[Entry]) -> List[Command]:
         commands: List[Command] = []
-        for e in self.storage.query(q, n):
-            command = self.parse_command(e.value)
+        for e in entries:
+            command = self._parse_entry(e)
             if command is not None:
                 commands.append(command)
         return commands
 
-    def save(self, command: Command):
+    def resolve(self, command: str) -> Optional[Command]:
+        return self.resolve_many([command]).get(command)
+
+    @traced("registry.resolve_many")
+    def resolve_many(self, commands: List[str]) -> Dict[str, Command]:
+        resolved, missing = self._resolve_cached(commands)
+        current_span().set("cache_misses", len(missing))
+        if len(missing) > 0:
+            for command in self._parse_entries(list(self.storage.get_many(missing).values())):
+                resolved[command.name] = command
+        return resolved
+
+    async def aresolve(self, command: str) -> Optional[Command]:
+        return (await self.aresolve_many([command])).get(command)
+
+    @traced("registry.resolve_many")
+    async def aresolve_many(self, commands: List[str]) -> Dict[str, Command]:
+        resolved, missing = self._resolve_cached(commands)
+        current_span().set("cache_misses", len(missing))
+        if len(missing) > 0:
+            for command in self._parse_entries(list((await self.storage.aget_many(missing)).values())):
+                resolved[command.name] = command
+        return resolved
+
+    def _query_key(self, q: str, n: int) -> Tuple[str, int]:
+        return " ".join(q.split()), n
+
+    def resolve_closure(self, commands: List[str]) -> Dict[str, Command]:
+        """
+        Resolve commands together with all the commands they depend on transitively.
+        Known dependencies are fetched in the same batch, and unknown ones in one batch per nesting level.
+        """
+
+        resolved: Dict[str, Command] = {}
+        attempted: Set[str] = set()
+        pending = set(commands)
+        while len(pending) > 0:
+            names = self.dependency_graph.closure(pending) - attempted
+            attempted |= names
+            resolved.update(self.resolve_many(list(names)))
+            pending = self.dependency_graph.closure(resolved.keys()) - attempted
+        return resolved
+
+    async def aresolve_closure(self, commands: List[str]) -> Dict[str, Command]:
+        resolved: Dict[str, Command] = {}
+        attempted: Set[str] = set()
+        pending = set(commands)
+        while len(pending) > 0:
+            names = self.dependency_graph.closure(pending) - attempted
+            attempted |= names
+            resolved.update(await self.aresolve_many(list(names)))
+            pending = self.dependency_graph.closure(resolved.keys()) - attempted
+        return resolved
+
+    def _lexical_scored(self, hits: List[LexicalHit], resolved: Dict[str, Command]) -> List[ScoredCommand]:
+        return [ScoredCommand(resolved[hit.key], hit.coverage, SOURCE_LEXICAL) for hit in hits if hit.key in resolved]
+
+    def _parse_scored(self, entries: List[Tuple[Entry, float]]) -> List[ScoredCommand]:
+        scored: List[ScoredCommand] = []
+        for entry, score in entries:
+            command = self._parse_entry(entry)
+            if command is not None:
+                scored.append(ScoredCommand(command, score, SOURCE_VECTOR))
+        return scored
+
+    def _fuse(self, lexical: List[ScoredCommand], vector: List[ScoredCommand], n: int) -> List[ScoredCommand]:
+        """
+        Merge the rankings by reciprocal rank fusion, preferring the vector ranking on ties.
+        Each command keeps its vector score if it has one, otherwise its lexical score.
+        """
+
+        rrf_scores: Dict[str, float] = {}
+        scored: Dict[str, ScoredCommand] = {}
+        for ranking in [vector, lexical]:
+            for rank, s in enumerate(ranking):
+                rrf_scores[s.command.name] = rrf_scores.get(s.command.name, 0.0) + 1 / (self.RRF_K + rank + 1)
+                scored.setdefault(s.command.name, s)
+
+        return [scored[name] for name in sorted(rrf_scores, key=lambda name: rrf_scores[name], reverse=True)[:n]]
+
+    def query(self, q: str, n: int) -> List[Command]:
+        return [s.command for s in self.query_with_scores(q, n)]
+
+    async def aquery(self, q: str, n: int) -> List[Command]:
+        return [s.command for s in await self.aquery_with_scores(q, n)]
+
+    @traced("registry.query_with_scores")
+    def query_with_scores(self, q: str, n: int) -> List[ScoredCommand]:
+        """
+        Fetch top n commands relevant to the query, with their scores from 0 to 1,
+        which are the vector similarity or the coverage of the query terms by the command name and description.
+        The coverage is 1 for any command containing all the query terms, so it does not tell that the command
+        matches the query; check the source of the score for that.
+        """
+
+        key = self._query_key(q, n)
+        scored = self._queries.get(key)
+        current_span().set("cache_hit", scored is not None)
+        if scored is None:
+            hits = self._lexical.search(q, n)
+            lexical = self._lexical_scored(hits, self.resolve_many([hit.key for hit in hits]))
+            lexical_only = self._lexical_only(hits)
+            current_span().set("lexical_only", lexical_only)
+            if lexical_only:
+                scored = lexical
+            else:
+                scored = self._fuse(lexical, self._parse_scored(self.storage.query_with_scores(q, n)), n)
+            self._queries.set(key, scored)
+        return list(scored)
+
+    @traced("registry.query_with_scores")
+    async def aquery_with_scores(self, q: str, n: int) -> List[ScoredCommand]:
+        key = self._query_key(q, n)
+        scored = self._queries.get(key)
+        current_span().set("cache_hit", scored is not None)
+        if scored is None:
+            hits = self._lexical.search(q, n)
+            lexical = self._lexical_scored(hits, await self.aresolve_many([hit.key for hit in hits]))
+            lexical_only = self._lexical_only(hits)
+            current_span().set("lexical_only", lexical_only)
+            if lexical_only:
+                scored = lexical
+            else:
+                scored = self._fuse(lexical, self._parse_scored(await self.storage.aquery_with_scores(q, n)), n)
+            self._queries.set(key, scored)
+        return list(scored)
+
+    def _entry(self, command: Command) -> Entry:
         if isinstance(command, CompositeCommand):
-            self.storage.set(Entry(command.name, json.dumps(command.to_json())), command.description)
-        else:
-            self.builtin_commands[command.name] = command
-            self.storage.set(
-                Entry(command.name, json.dumps({"type": "__builtin__", "name": command.name})),
-                command.description,
-            )
+            return Entry(command.name, json.dumps(command.to_json()))
+        return Entry(
+            command.name,
+            json.dumps({"type": "__builtin__", "name": command.name, "fingerprint": command_fingerprint(command)}),
+        )
+
+    def save(self, command: Command):
+        self.save_many([command])
+
+    @traced("registry.save_many")
+    def save_many(self, commands: List[Command]):
+        """
+        Save commands at once, embedding and writing them in a batch.
+        """
+
+        if len(commands) > 0:
+            entries = self._before_save(commands)
+            self.storage.set_many(entries)
+            self._after_save(entries, commands)
+
+    async def asave(self, command: Command):
+        await self.asave_many([command])
+
+    @traced("registry.save_many")
+    async def asave_many(self, commands: List[Command]):
+        if len(commands) > 0:
+            entries = self._before_save(commands)
+            await self.storage.aset_many(entries)
+            self._after_save(entries, commands)
+
+    def _before_save(self, commands: List[Command]) -> List[Tuple[Entry, str]]:
+        for command in commands:
+            if not isinstance(command, CompositeCommand):
+                self.builtin_commands[command.name] = command
+
+        # Commands executing the saved ones are parsed again on the next lookup
+        for name in self.dependency_graph.dependents([c.name for c in commands]):
+            self._commands.delete(name)
+        self._queries.clear()
+        return [(self._entry(command), command.description) for command in commands]
+
+    def _after_save(self, entries: List[Tuple[Entry, str]], commands: List[Command]):
+        for (entry, _), command in zip(entries, commands):
+            self._cache(entry, command)
+        # Clear again the results of the queries run while saving
+        self._queries.clear()
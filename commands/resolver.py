@@ -1,5 +1,5 @@
 import abc
-from typing import Optional
+from typing import Dict, List, Optional
 from commands.command import Command
 
 
@@ -13,3 +13,43 @@ class CommandResolver(metaclass=abc.ABCMeta):
         @return: command object if found, otherwise None
         """
         raise NotImplementedError()
+
+    def resolve_many(self, commands: List[str]) -> Dict[str, Command]:
+        """
+        Resolve commands by names at once. Override this if commands can be fetched in a batch.
+
+        @param commands: command names
+        @return: found command objects, keyed by their names
+        """
+
+        resolved: Dict[str, Command] = {}
+        for name in commands:
+            command = self.resolve(name)
+            if command is not None:
+                resolved[name] = command
+        return resolved
+
+    async def aresolve(self, command: str) -> Optional[Command]:
+        """
+        Async version of resolve. Override this not to block the event loop.
+        """
+
+        return self.resolve(command)
+
+    async def aresolve_many(self, commands: List[str]) -> Dict[str, Command]:
+        """
+        Async version of resolve_many. Override this not to block the event loop.
+        """
+
+        return self.resolve_many(commands)
+
+    async def aresolve_closure(self, commands: List[str]) -> Dict[str, Command]:
+        """
+        Resolve commands together with all the commands they depend on, to be executed without further lookups.
+        Override this if the dependencies can be known in advance.
+
+        @param commands: command names
+        @return: found command objects including the dependencies, keyed by their names
+        """
+
+        return await self.aresolve_many(commands)
@@ -1,4 +1,5 @@
-from typing import Any, Dict, List, NamedTuple, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from commands.binding import Binding
 from commands.command import RETURN_COMMAND_NAME, Command, ReturnCommand, Variable
 from commands.composite import CompositeCommand
 
@@ -14,9 +15,15 @@ from channels.channel import Channel
 
 
 class CommandStep(NamedTuple):
+    """
+    @param bindings: how the input of the command was built from the input variables in the recorded run,
+        to build it again without the LLM (None if unknown)
+    """
+
     id: str
     command: str
     input_variables: List[str]
+    bindings: Optional[List[Binding]] = None
 
 
 class SequentialCommandStepCommand(CompositeCommand):
@@ -70,11 +77,11 @@ class SequentialCommandStepCommand(CompositeCommand):
             ]
         )
 
-    def _resolve_command(self, command: str) -> Union[Command, None]:
-        if command == RETURN_COMMAND_NAME:
-            return ReturnCommand(self.output_schema)
-        else:
-            return self.command_resolver.resolve(command)
+    async def _resolve_commands(self, commands: List[str]) -> Dict[str, Command]:
+        resolved = await self.command_resolver.aresolve_closure([c for c in commands if c != RETURN_COMMAND_NAME])
+        if RETURN_COMMAND_NAME in commands:
+            resolved[RETURN_COMMAND_NAME] = ReturnCommand(self.output_schema)
+        return resolved
 
     def _step_summary(self, step: CommandStep, inputs: List[Variable], outputs: Any, error: str) -> Any:
         summary = {
@@ -95,14 +102,19 @@ class SequentialCommandStepCommand(CompositeCommand):
         for name, description in self.input_variables.items():
             variables[name] = Variable(name, description, inputs[name])
 
+        # Resolve all the sub-commands, including nested ones, before the first step
+        commands = await self._resolve_commands([step.command for step in self.steps])
+
         for step in self.steps:
-            command = self._resolve_command(step.command)
+            command = commands.get(step.command)
             if command is None:
                 raise Exception(f"Command {step.command} not found")
 
             step_inputs = list(map(lambda v: variables[v], step.input_variables))
 
-            outputs, error = await self.command_executor.execute(command, step_inputs, channel)
+            _, outputs, error = await self.command_executor.execute_with_inputs(
+                command, step_inputs, channel, bindings=step.bindings
+            )
             if error != "":
                 return None, error
 
@@ -138,5 +150,5 @@ class SequentialCommandStepCommand(CompositeCommand):
             "description": self.description,
             "input_variables": self.input_variables,
             "output_variables": self.output_variables,
-            "steps": list(map(lambda s: s._asdict(), self.steps)),
+            "steps": list(map(lambda s: {k: v for k, v in s._asdict().items() if v is not None}, self.steps)),
         }
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+from commands.command import Variable
+
+REF_PREFIX = "$ref:"
+
+
+class SpilledValue:
+    """
+    A variable value kept in a file, loaded only when a command receives it.
+
+    @param path: path of the JSON file holding the value
+    @param size: size of the serialized value in bytes
+    @param preview: beginning of the serialized value
+    """
+
+    path: str
+    size: int
+    preview: str
+
+    def __init__(self, path: str, size: int, preview: str):
+        self.path = path
+        self.size = size
+        self.preview = preview
+
+    def load(self) -> Any:
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def __repr__(self) -> str:
+        return f"SpilledValue({self.path!r}, size={self.size})"
+
+
+def materialize(value: Any) -> Any:
+    """
+    @return: the full value, loading it from the file if spilled
+    """
+
+    return value.load() if isinstance(value, SpilledValue) else value
+
+
+def preview_value(value: Any, max_chars: int) -> Optional[str]:
+    """
+    Render a value for the prompt, truncated to max_chars.
+
+    @return: the truncated JSON with the total size, or None if the value fits as it is
+    """
+
+    if isinstance(value, SpilledValue):
+        return f"{value.preview[:max_chars]}... ({value.size} bytes in total)"
+
+    body = json.dumps(value, ensure_ascii=False)
+    if len(body) <= max_chars:
+        return None
+    return f"{body[:max_chars]}... ({len(body)} characters in total)"
+
+
+def resolve_refs(data: Any, variables: Dict[str, Variable]) -> Any:
+    """
+    Replace the strings like "$ref:steps.0.output" in the data with the full values of the variables.
+    """
+
+    if isinstance(data, str) and data.startswith(REF_PREFIX):
+        name = data[len(REF_PREFIX) :].strip()
+        return materialize(variables[name].value) if name in variables else data
+    if isinstance(data, list):
+        return [resolve_refs(d, variables) for d in data]
+    if isinstance(data, dict):
+        return {k: resolve_refs(v, variables) for k, v in data.items()}
+    return data
+
+
+class VariableStore:
+    """
+    Keeps large variable values out of memory by writing them to files.
+    The values are referenced by SpilledValue until a command receives them.
+
+    @param path: directory to write the values to, or None for a temporary directory removed on close()
+    @param spill_bytes: minimum size of a serialized value to write to a file
+    @param preview_chars: number of characters of a spilled value kept in memory for the prompt
+    """
+
+    path: str
+    spill_bytes: int
+    preview_chars: int
+
+    def __init__(self, path: Optional[str] = None, spill_bytes: int = 100000, preview_chars: int = 2000):
+        self._temporary = path is None
+        self.path = tempfile.mkdtemp(prefix="variables-") if path is None else path
+        self.spill_bytes = spill_bytes
+        self.preview_chars = preview_chars
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, variable: Variable) -> Variable:
+        """
+        @return: the variable to keep, whose value is a SpilledValue if it's large
+        """
+
+        if isinstance(variable.value, SpilledValue):
+            return variable
+
+        body = json.dumps(variable.value, ensure_ascii=False)
+        data = body.encode("utf-8")
+        if len(data) < self.spill_bytes:
+            return variable
+
+        # Identical values share a file
+        path = os.path.join(self.path, hashlib.sha256(data).hexdigest() + ".json")
+        with self._lock:
+            if not os.path.exists(path):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+
+        return Variable(variable.name, variable.description, SpilledValue(path, len(data), body[: self.preview_chars]))
+
+    def close(self):
+        """
+        Remove the temporary directory, if any. Spilled values can't be loaded afterwards.
+        """
+
+        if self._temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
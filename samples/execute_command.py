@@ -6,6 +6,7 @@ from commands.registry import CommandRegistry
 from langchain.embeddings import OpenAIEmbeddings
 import pinecone
 from langchain import OpenAI
+from storage.embeddings import CachedEmbeddings
 from storage.pinecone import PineconeDB
 
 COMMAND_NAME = "SaveTextToNotionDatbaseAndReturnPageURL"
@@ -34,13 +35,13 @@ async def execute_command():
     pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT"])
     index = pinecone.Index(os.environ["PINECONE_COMMANDS_INDEX_NAME"])
 
-    emb = OpenAIEmbeddings()
+    emb = CachedEmbeddings(OpenAIEmbeddings(), path=".cache/embeddings.sqlite")
     storage = PineconeDB(index, emb)
 
     command_registry = CommandRegistry(notion_commands(token=os.environ["NOTION_TOKEN"]), storage, command_llm)
     channel = ChannelConsole()
 
-    command = command_registry.resolve(COMMAND_NAME)
+    command = await command_registry.aresolve(COMMAND_NAME)
     if command is None:
         raise Exception(f"Command {COMMAND_NAME} not found")
 
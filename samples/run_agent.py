@@ -9,6 +9,7 @@ from dotenv import load_dotenv
 from langchain import OpenAI
 from langchain.embeddings import OpenAIEmbeddings
 import pinecone
+from storage.embeddings import CachedEmbeddings
 from storage.pinecone import PineconeDB
 
 # Generated by ChatGPT
@@ -41,7 +42,7 @@ async def run_agent():
     pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT"])
     index = pinecone.Index(os.environ["PINECONE_COMMANDS_INDEX_NAME"])
 
-    emb = OpenAIEmbeddings()
+    emb = CachedEmbeddings(OpenAIEmbeddings(), path=".cache/embeddings.sqlite")
     storage = PineconeDB(index, emb)
 
     command_registry = CommandRegistry(notion_commands(token=os.environ["NOTION_TOKEN"]), storage, command_llm)
@@ -58,5 +59,5 @@ async def run_agent():
         command = create_sequential_command_from_agent_run(name, run, command_llm, command_registry)
         print(command.to_json())
 
-        command_registry.save(command)
+        await command_registry.asave(command)
         print("Command saved.")
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import Iterator, Optional
+from agents.agent import CommandBasedAgent
+from agents.batch import BatchRunner
+from agents.task import Task, build_task
+from channels.log import ChannelLog
+from commands.notion.commands import notion_commands
+from commands.registry import CommandRegistry
+from dotenv import load_dotenv
+from langchain import OpenAI
+from langchain.embeddings import OpenAIEmbeddings
+import pinecone
+from storage.embeddings import CachedEmbeddings
+from storage.pinecone import PineconeDB
+from utils.llm import CompletionCache
+from utils.tracing import JSONLSpanExporter, set_exporter
+
+
+def read_tasks(path: str) -> Iterator[Task]:
+    """
+    Read tasks from a JSONL file, one task per line like:
+    {"text": "Save [the given text](text) into ...", "inputs": {"text": "...", "database_name": "Test"}}
+    """
+
+    with sys.stdin if path == "-" else open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            data = json.loads(line)
+            yield build_task(data["text"], data.get("inputs", {}))
+
+
+async def run_batch(path: str, concurrency: int, trace: Optional[str], approve: bool):
+    load_dotenv(verbose=True)
+    if trace is not None:
+        set_exporter(JSONLSpanExporter(trace))
+
+    plan_llm = OpenAI(temperature=0, max_tokens=200, model_kwargs={"stop": CommandBasedAgent.STOP_WORD})
+    command_llm = OpenAI(temperature=0, max_tokens=1500)
+
+    pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT"])
+    index = pinecone.Index(os.environ["PINECONE_COMMANDS_INDEX_NAME"])
+
+    emb = CachedEmbeddings(OpenAIEmbeddings(), path=".cache/embeddings.sqlite")
+    storage = PineconeDB(index, emb)
+
+    # Completions are reusable with temperature=0, e.g. when re-running a failed batch
+    plan_cache = CompletionCache(".cache/completions.sqlite")
+    command_cache = CompletionCache(".cache/completions.sqlite")
+
+    command_registry = CommandRegistry(notion_commands(token=os.environ["NOTION_TOKEN"]), storage, command_llm)
+    command_registry.completion_cache = command_cache
+    # Messages go to stderr to keep stdout for the results, and stdin may be the tasks,
+    # so that human checks are answered by the --approve flag instead
+    channel = ChannelLog("OK") if approve else ChannelLog()
+
+    agent = CommandBasedAgent(plan_llm, command_llm, channel)
+    agent.plan_completion_cache = plan_cache
+    agent.command_executor.completion_cache = command_cache
+    runner = BatchRunner(agent, command_registry, concurrency=concurrency)
+
+    # Results are written to stdout as JSONL in the order they finish
+    async for result in runner.run(read_tasks(path)):
+        line = {
+            "index": result.index,
+            "task": result.task.text,
+            "result": result.run.result if result.run is not None else None,
+            "error": result.error,
+            "duration": result.duration,
+        }
+        print(json.dumps(line, ensure_ascii=False), flush=True)
+
+    report = runner.report()
+    print(
+        f"{report.total} tasks ({report.failures} failed) in {report.elapsed:.1f}s: "
+        f"{report.throughput:.2f} tasks/s, p50 {report.p50:.1f}s, p95 {report.p95:.1f}s",
+        file=sys.stderr,
+    )
+    print(f"Embedding cache: {emb.stats()}", file=sys.stderr)
+    print(f"Completion cache: planning {plan_cache.stats()}, commands {command_cache.stats()}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the agent on the tasks in a JSONL file")
+    parser.add_argument("path", help='JSONL file of tasks, or "-" to read from stdin')
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum number of tasks running at the same time")
+    parser.add_argument("--trace", help="JSONL file to write the tracing spans to")
+    parser.add_argument(
+        "--approve",
+        action="store_true",
+        help="approve the inputs of the commands requiring human check (rejected otherwise)",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run_batch(args.path, args.concurrency, args.trace, args.approve))
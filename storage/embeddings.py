@@ -0,0 +1,101 @@
+import hashlib
+from array import array
+from typing import Any, Dict, List, Optional
+from langchain.embeddings.base import Embeddings
+from utils.cache import LRUCache, SQLiteStore
+from utils.tracing import current_span, traced
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings which caches the vectors of the texts embedded before,
+    in memory and optionally on disk, keyed by the hash of the model name and the text.
+
+    @param embeddings: embeddings to compute the vectors on cache misses
+    @param path: path to the SQLite file to persist the vectors, or None to cache only in memory
+    @param max_memory_entries: maximum number of vectors to keep in memory
+    @param max_disk_entries: maximum number of vectors to keep on disk
+    """
+
+    embeddings: Embeddings
+    model: str
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        path: Optional[str] = None,
+        max_memory_entries: int = 10000,
+        max_disk_entries: int = 1000000,
+    ):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.memory: LRUCache[str, List[float]] = LRUCache(max_memory_entries)
+        self.disk = SQLiteStore(path, max_disk_entries) if path is not None else None
+
+    def _key(self, kind: str, text: str) -> str:
+        # Documents and queries are distinguished, since some models embed them differently
+        return hashlib.sha256(f"{self.model}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        vector = self.memory.get(key)
+        if vector is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                vector = array("d", data).tolist()
+                self.memory.set(key, vector)
+
+        if vector is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return vector
+
+    def _store(self, key: str, vector: List[float]):
+        self.memory.set(key, vector)
+        if self.disk is not None:
+            self.disk.set(key, array("d", vector).tobytes())
+
+    @traced("embeddings.embed_documents")
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("document", t) for t in texts]
+        vectors: Dict[str, List[float]] = {}
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            vector = self._lookup(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+
+        current_span().set("texts", len(texts))
+        current_span().set("cache_misses", len(missing))
+
+        # Embed all the missing texts in a single call
+        if len(missing) > 0:
+            for key, vector in zip(missing.keys(), self.embeddings.embed_documents(list(missing.values()))):
+                self._store(key, vector)
+                vectors[key] = vector
+
+        return [vectors[key] for key in keys]
+
+    @traced("embeddings.embed_query")
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        vector = self._lookup(key)
+        current_span().set("cache_hit", vector is not None)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        @return: cache statistics, like {"hits": 10, "misses": 2, "hit_rate": 0.83}
+        """
+
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total > 0 else 0.0}
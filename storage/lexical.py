@@ -0,0 +1,122 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, NamedTuple
+
+STOP_WORDS = set("a an and are as at be by for from in into is it of on or that the this to with".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text into lowercase terms, also splitting CamelCase words like "SearchNotionDatabasesCommand".
+    """
+
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    text = re.sub(r"([A-Z]+)([A-Z][a-z])", r"\1 \2", text)
+
+    terms: List[str] = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOP_WORDS:
+            continue
+        # Crude plural folding, e.g. "databases" -> "database"
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class LexicalHit(NamedTuple):
+    """
+    @param key: key of the matched document
+    @param score: BM25 score
+    @param coverage: idf-weighted fraction of the query terms contained in the document (0 to 1)
+    """
+
+    key: str
+    score: float
+    coverage: float
+
+
+class LexicalIndex:
+    """
+    An in-memory inverted index ranking documents by BM25.
+
+    @param k1: BM25 term frequency saturation
+    @param b: BM25 document length normalization
+    """
+
+    k1: float
+    b: float
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: Dict[str, Counter] = {}
+        self._lengths: Dict[str, int] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, key: str, text: str):
+        """
+        Add a document, replacing the one with the same key.
+        """
+
+        terms = Counter(tokenize(text))
+        with self._lock:
+            if self._docs.get(key) == terms:
+                return
+            self._remove(key)
+            self._docs[key] = terms
+            self._lengths[key] = sum(terms.values())
+            self._total_length += self._lengths[key]
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[key] = tf
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        terms = self._docs.pop(key, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(key)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[key]
+            if len(postings) == 0:
+                del self._postings[term]
+
+    def _idf(self, term: str) -> float:
+        df = len(self._postings.get(term, {}))
+        return math.log(1 + (len(self._docs) - df + 0.5) / (df + 0.5))
+
+    def search(self, q: str, n: int) -> List[LexicalHit]:
+        """
+        Fetch top n documents matching the query, in the descending order of the score.
+        """
+
+        with self._lock:
+            if len(self._docs) == 0 or n <= 0:
+                return []
+
+            terms = set(tokenize(q))
+            idfs = {term: self._idf(term) for term in terms}
+            total_idf = sum(idfs.values())
+            average_length = self._total_length / len(self._docs)
+
+            scores: Dict[str, float] = {}
+            matched_idf: Dict[str, float] = {}
+            for term in terms:
+                for key, tf in self._postings.get(term, {}).items():
+                    norm = tf + self.k1 * (1 - self.b + self.b * self._lengths[key] / average_length)
+                    scores[key] = scores.get(key, 0.0) + idfs[term] * tf * (self.k1 + 1) / norm
+                    matched_idf[key] = matched_idf.get(key, 0.0) + idfs[term]
+
+        top = sorted(scores.items(), key=lambda s: s[1], reverse=True)[:n]
+        return [LexicalHit(key, score, matched_idf[key] / total_idf if total_idf > 0 else 0.0) for key, score in top]
@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from storage.storage import Entry, Storage
+from utils.tracing import traced
+
+
+class LocalDB(Storage):
+    """
+    A storage kept on the local filesystem, which works without any network round trip except embeddings.
+
+    Vectors are appended to a float32 matrix file which is memory-mapped for querying,
+    and entries are appended to a JSONL log mapping each key to the row of its latest vector.
+
+    @param path: directory to store the files in (created if missing)
+    @param embeddings: embeddings to vectorize descriptions and queries
+    """
+
+    VECTORS_FILE = "vectors.f32"
+    ENTRIES_FILE = "entries.jsonl"
+    META_FILE = "meta.json"
+
+    path: str
+    embeddings: Embeddings
+    dimension: Optional[int]
+
+    def __init__(self, path: str, embeddings: Embeddings):
+        self.path = path
+        self.embeddings = embeddings
+        self.dimension = None
+
+        self._rows: Dict[str, int] = {}
+        self._values: Dict[str, str] = {}
+        self._keys: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._live: Optional[np.ndarray] = None
+        self._lock = threading.RLock()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if os.path.exists(self._file(self.META_FILE)):
+            with open(self._file(self.META_FILE)) as f:
+                self.dimension = json.load(f)["dimension"]
+
+        if not os.path.exists(self._file(self.ENTRIES_FILE)):
+            return
+
+        end = 0
+        with open(self._file(self.ENTRIES_FILE), "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A partially written last line
+                    break
+                end += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._append_row(record["key"], record["value"])
+
+        # Drop the partial line, otherwise the next entry would be appended onto it
+        if os.path.getsize(self._file(self.ENTRIES_FILE)) > end:
+            os.truncate(self._file(self.ENTRIES_FILE), end)
+
+        # Drop a vector written without its entry being logged
+        if self.dimension is not None and os.path.exists(self._file(self.VECTORS_FILE)):
+            size = len(self._keys) * self.dimension * np.dtype(np.float32).itemsize
+            if os.path.getsize(self._file(self.VECTORS_FILE)) > size:
+                os.truncate(self._file(self.VECTORS_FILE), size)
+
+    def _append_row(self, key: str, value: str):
+        self._rows[key] = len(self._keys)
+        self._values[key] = value
+        self._keys.append(key)
+        self._matrix = None
+
+    def _vectors(self) -> np.ndarray:
+        """
+        @return: matrix of the vectors (rows x dimension), memory-mapped from the file
+        """
+
+        if self._matrix is None:
+            rows = len(self._keys)
+            if rows == 0 or self.dimension is None:
+                self._matrix = np.zeros((0, self.dimension or 0), dtype=np.float32)
+            else:
+                self._matrix = np.memmap(
+                    self._file(self.VECTORS_FILE), dtype=np.float32, mode="r", shape=(rows, self.dimension)
+                )
+
+            # Rows overwritten by a later set of the same key are excluded from queries
+            self._live = np.zeros(rows, dtype=bool)
+            self._live[list(self._rows.values())] = True
+
+        return self._matrix
+
+    def _normalize(self, vector: List[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else v
+
+    def get(self, key: str) -> Union[Entry, None]:
+        if key in self._values:
+            return Entry(key, self._values[key])
+        return None
+
+    @traced("storage.get_many", lambda s, r: s.set("entries", len(r)), backend="local")
+    def get_many(self, keys: List[str]) -> Dict[str, Entry]:
+        return {key: Entry(key, self._values[key]) for key in keys if key in self._values}
+
+    def entries(self) -> Optional[List[Entry]]:
+        with self._lock:
+            return [Entry(key, value) for key, value in self._values.items()]
+
+    # Entries are in memory, so that reads need no offloading
+    async def aget(self, key: str) -> Union[Entry, None]:
+        return self.get(key)
+
+    async def aget_many(self, keys: List[str]) -> Dict[str, Entry]:
+        return self.get_many(keys)
+
+    def set(self, entry: Entry, description: str):
+        self.set_many([(entry, description)])
+
+    @traced("storage.set_many", backend="local")
+    def set_many(self, entries: List[Tuple[Entry, str]]):
+        if len(entries) == 0:
+            return
+
+        vectors = [
+            self._normalize(v) for v in self.embeddings.embed_documents([description for _, description in entries])
+        ]
+
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = len(vectors[0])
+                with open(self._file(self.META_FILE), "w") as f:
+                    json.dump({"dimension": self.dimension}, f)
+            for v in vectors:
+                if len(v) != self.dimension:
+                    raise ValueError(f"Expected a vector of {self.dimension} dimensions, but got {len(v)}")
+
+            # The vectors are written before the entries, so that every logged entry has its row
+            with open(self._file(self.VECTORS_FILE), "ab") as f:
+                f.write(np.stack(vectors).tobytes())
+            with open(self._file(self.ENTRIES_FILE), "a", encoding="utf-8") as f:
+                for entry, _ in entries:
+                    f.write(json.dumps({"key": entry.key, "value": entry.value}, ensure_ascii=False) + "\n")
+
+            for entry, _ in entries:
+                self._append_row(entry.key, entry.value)
+
+    def query(self, q: str, n: int) -> List[Entry]:
+        return [entry for entry, _ in self.query_with_scores(q, n)]
+
+    @traced("storage.query_with_scores", lambda s, r: s.set("entries", len(r)), backend="local")
+    def query_with_scores(self, q: str, n: int) -> List[Tuple[Entry, float]]:
+        vector = self._normalize(self.embeddings.embed_query(q))
+
+        with self._lock:
+            matrix = self._vectors()
+            live = self._live
+            keys = self._keys
+        if n <= 0 or len(matrix) == 0:
+            return []
+
+        scores = matrix @ vector
+        scores[~live] = -np.inf
+
+        k = min(n, int(live.sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(Entry(keys[i], self._values[keys[i]]), float(scores[i])) for i in top]
+
+    def compact(self):
+        """
+        Rewrite the files dropping the rows overwritten by later sets, to reclaim the disk space.
+        """
+
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        matrix = self._vectors()
+        keys = sorted(self._rows, key=lambda k: self._rows[k])
+        rows = [self._rows[k] for k in keys]
+
+        vectors_tmp = self._file(self.VECTORS_FILE + ".tmp")
+        entries_tmp = self._file(self.ENTRIES_FILE + ".tmp")
+        with open(vectors_tmp, "wb") as f:
+            f.write(np.ascontiguousarray(matrix[rows]).tobytes())
+        del matrix
+        with open(entries_tmp, "w", encoding="utf-8") as f:
+            for k in keys:
+                f.write(json.dumps({"key": k, "value": self._values[k]}, ensure_ascii=False) + "\n")
+
+        self._matrix = None
+        os.replace(vectors_tmp, self._file(self.VECTORS_FILE))
+        os.replace(entries_tmp, self._file(self.ENTRIES_FILE))
+
+        self._rows, self._keys = {}, []
+        for k in keys:
+            self._append_row(k, self._values[k])
@@ -1,33 +1,59 @@
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 from langchain.embeddings.base import Embeddings
 import pinecone
 from storage.storage import Entry, Storage
+from utils.tracing import traced
 
 
 class PineconeDB(Storage):
     index: pinecone.Index
     embeddings: Embeddings
 
+    # Limits on the number of vectors per request
+    FETCH_BATCH_SIZE = 1000
+    UPSERT_BATCH_SIZE = 100
+
     def __init__(self, index: pinecone.Index, embeddings: Embeddings):
         self.index = index
         self.embeddings = embeddings
 
     def get(self, key: str) -> Union[Entry, None]:
-        response = self.index.fetch([key])
-        if key in response.get("vectors", {}):
-            props = response.get("vectors")[key]
-            return Entry(props["id"], props["metadata"]["value"])
-        return None
+        return self.get_many([key]).get(key)
+
+    @traced("storage.get_many", lambda s, r: s.set("entries", len(r)), backend="pinecone")
+    def get_many(self, keys: List[str]) -> Dict[str, Entry]:
+        if len(keys) == 0:
+            return {}
+
+        entries: Dict[str, Entry] = {}
+        for i in range(0, len(keys), self.FETCH_BATCH_SIZE):
+            response = self.index.fetch(keys[i : i + self.FETCH_BATCH_SIZE])
+            for key, props in response.get("vectors", {}).items():
+                entries[key] = Entry(props["id"], props["metadata"]["value"])
+        return entries
 
     def set(self, entry: Entry, description: str):
-        [vector] = self.embeddings.embed_documents([description])
-        self.index.upsert([(entry.key, vector, {"value": entry.value})])
+        self.set_many([(entry, description)])
+
+    @traced("storage.set_many", backend="pinecone")
+    def set_many(self, entries: List[Tuple[Entry, str]]):
+        if len(entries) == 0:
+            return
+
+        vectors = self.embeddings.embed_documents([description for _, description in entries])
+        items = [(entry.key, vector, {"value": entry.value}) for (entry, _), vector in zip(entries, vectors)]
+        for i in range(0, len(items), self.UPSERT_BATCH_SIZE):
+            self.index.upsert(items[i : i + self.UPSERT_BATCH_SIZE])
 
     def query(self, q: str, n: int) -> List[Entry]:
+        return [entry for entry, _ in self.query_with_scores(q, n)]
+
+    @traced("storage.query_with_scores", lambda s, r: s.set("entries", len(r)), backend="pinecone")
+    def query_with_scores(self, q: str, n: int) -> List[Tuple[Entry, float]]:
         vector = self.embeddings.embed_query(q)
         response = self.index.query(vector, include_metadata=True, top_k=n)
 
-        entries: List[Entry] = []
+        entries: List[Tuple[Entry, float]] = []
         for m in response.get("matches", []):
-            entries.append(Entry(m.id, m.metadata["value"]))
+            entries.append((Entry(m.id, m.metadata["value"]), m.score))
         return entries
@@ -1,5 +1,21 @@
 import abc
-from typing import List, NamedTuple, Union
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+# Maximum number of blocking storage calls running at the same time for the async API
+MAX_WORKERS = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def default_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="storage")
+    return _executor
 
 
 class Entry(NamedTuple):
@@ -8,6 +24,16 @@ class Entry(NamedTuple):
 
 
 class Storage(metaclass=abc.ABCMeta):
+    """
+    A key-value store whose entries can be queried by description.
+
+    The async methods offload the blocking ones to a bounded thread pool by default,
+    so that backends need to override them only if they have native async support.
+    """
+
+    # Thread pool for the async methods, or None to use the shared default one
+    executor: Optional[ThreadPoolExecutor] = None
+
     @abc.abstractmethod
     def get(self, key: str) -> Union[Entry, None]:
         raise NotImplementedError()
@@ -16,6 +42,31 @@ class Storage(metaclass=abc.ABCMeta):
     def set(self, entry: Entry, description: str):
         raise NotImplementedError()
 
+    def get_many(self, keys: List[str]) -> Dict[str, Entry]:
+        """
+        Fetch entries by keys at once. Override this if the backend supports batched reads.
+
+        @param keys: keys to fetch
+        @return: found entries, keyed by their keys
+        """
+
+        entries: Dict[str, Entry] = {}
+        for key in keys:
+            entry = self.get(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def set_many(self, entries: List[Tuple[Entry, str]]):
+        """
+        Save entries at once. Override this if the backend supports batched writes.
+
+        @param entries: list of (entry, description)
+        """
+
+        for entry, description in entries:
+            self.set(entry, description)
+
     @abc.abstractmethod
     def query(self, q: str, n: int) -> List[Entry]:
         """
@@ -26,3 +77,49 @@ class Storage(metaclass=abc.ABCMeta):
         """
 
         raise NotImplementedError()
+
+    def query_with_scores(self, q: str, n: int) -> List[Tuple[Entry, float]]:
+        """
+        Fetch top n entries whose description match the query, with their similarity scores.
+        Override this if the backend reports scores; otherwise every score is 0.
+
+        @param q: query
+        @param n: number of entries to fetch
+        @return: list of (entry, score), where score is the similarity to the query (1 for the best match)
+        """
+
+        return [(entry, 0.0) for entry in self.query(q, n)]
+
+    def entries(self) -> Optional[List[Entry]]:
+        """
+        Fetch all the entries. Override this if the backend can list them without a network round trip.
+
+        @return: all the entries, or None if the backend cannot list them
+        """
+
+        return None
+
+    async def _offload(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        # Run in the current context, so that the call is traced in the current span
+        context = contextvars.copy_context()
+        executor = self.executor or default_executor()
+        return await loop.run_in_executor(executor, functools.partial(context.run, fn, *args))
+
+    async def aget(self, key: str) -> Union[Entry, None]:
+        return await self._offload(self.get, key)
+
+    async def aset(self, entry: Entry, description: str):
+        await self._offload(self.set, entry, description)
+
+    async def aget_many(self, keys: List[str]) -> Dict[str, Entry]:
+        return await self._offload(self.get_many, keys)
+
+    async def aset_many(self, entries: List[Tuple[Entry, str]]):
+        await self._offload(self.set_many, entries)
+
+    async def aquery(self, q: str, n: int) -> List[Entry]:
+        return await self._offload(self.query, q, n)
+
+    async def aquery_with_scores(self, q: str, n: int) -> List[Tuple[Entry, float]]:
+        return await self._offload(self.query_with_scores, q, n)
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    An in-memory cache evicting the least recently used item.
+
+    @param max_size: maximum number of items to keep
+    @param ttl: seconds until an item expires, or None to keep items until evicted
+    """
+
+    max_size: int
+    ttl: Optional[float]
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+
+            created_at, value = item
+            if self.ttl is not None and time.monotonic() - created_at > self.ttl:
+                del self._items[key]
+                return None
+
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: K, value: V):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key: K):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class SQLiteStore:
+    """
+    A key-value store on a SQLite file, evicting the least recently used items.
+    The file can be shared by multiple processes on the same host.
+    Eviction runs every EVICT_INTERVAL sets, so the store may exceed max_entries by that many items per process.
+
+    @param path: path to the SQLite file
+    @param max_entries: maximum number of items to keep
+    """
+
+    # Number of sets between evictions, which count the whole table
+    EVICT_INTERVAL = 1000
+
+    path: str
+    max_entries: int
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._sets = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, value BLOB NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_accessed_at ON items (accessed_at)")
+        # Also on startup, for processes setting fewer items than the interval
+        self._evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM items WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE items SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO items (key, value, accessed_at) VALUES (?, ?, ?)", (key, value, time.time())
+            )
+            self._sets += 1
+            if self._sets >= self.EVICT_INTERVAL:
+                self._sets = 0
+                self._evict()
+
+    def _evict(self):
+        [count] = self._conn.execute("SELECT COUNT(*) FROM items").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM items WHERE key IN (SELECT key FROM items ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
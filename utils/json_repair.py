@@ -0,0 +1,127 @@
+import ast
+import json
+import re
+from typing import Any, List, Optional
+
+
+def _find_value(text: str, offset: int = 0) -> Optional[str]:
+    """
+    @return: the first balanced JSON object or array in the text from the offset, or None if not found
+    """
+
+    start = min([i for i in (text.find("{", offset), text.find("[", offset)) if i >= 0], default=-1)
+    if start < 0:
+        return None
+
+    depth = 0
+    quote: Optional[str] = None
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+
+    # Not closed, like an output cut off by the token limit
+    return text[start:]
+
+
+def _replace_outside_strings(text: str, pattern: str, replacement: str) -> str:
+    """
+    Replace the pattern only in the parts of the text outside quoted strings, keeping the values intact.
+    """
+
+    parts: List[str] = []
+    start = 0
+    quote: Optional[str] = None
+    escaped = False
+    for i, c in enumerate(text):
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                parts.append(text[start : i + 1])
+                start = i + 1
+                quote = None
+        elif c in "\"'":
+            parts.append(re.sub(pattern, replacement, text[start:i]))
+            start = i
+            quote = c
+
+    rest = text[start:]
+    parts.append(rest if quote is not None else re.sub(pattern, replacement, rest))
+    return "".join(parts)
+
+
+def _parse(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    # Trailing commas
+    fixed = _replace_outside_strings(text, r",\s*([}\]])", r"\1")
+    try:
+        return json.loads(fixed)
+    except json.JSONDecodeError:
+        pass
+
+    # Single quotes and Python literals
+    literal = fixed
+    for word, python in [("true", "True"), ("false", "False"), ("null", "None")]:
+        literal = _replace_outside_strings(literal, rf"\b{word}\b", python)
+    try:
+        value = ast.literal_eval(literal)
+        # Round trip to make sure the value is JSON, like tuples to lists
+        return json.loads(json.dumps(value))
+    except (ValueError, SyntaxError, TypeError):
+        # TypeError for Python values which are not JSON, like {[1]: 2} or sets
+        raise ValueError(f"Invalid JSON: {text[:200]}")
+
+
+def extract_json(text: str) -> Any:
+    """
+    Extract a JSON value from an LLM output, tolerating code fences, prose around it,
+    single quotes and trailing commas.
+
+    @raise ValueError: if no JSON value is found
+    """
+
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    fence = re.search(r"```(?:json|JSON)?\s*\n?(.*?)(?:```|$)", text, re.DOTALL)
+    if fence:
+        text = fence.group(1)
+
+    value = _find_value(text)
+    if value is None:
+        return _parse(text.strip())
+
+    # Try the next object or array after one failing to parse, like "[note]" in 'See [note]: {"a": 1}'
+    error: Optional[ValueError] = None
+    offset = 0
+    while value is not None:
+        try:
+            return _parse(value)
+        except ValueError as e:
+            error = error or e
+        offset = text.index(value, offset) + len(value)
+        value = _find_value(text, offset)
+    raise error
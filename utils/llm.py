@@ -0,0 +1,110 @@
+import asyncio
+import functools
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+from langchain import LLMChain
+from langchain.llms.base import BaseLLM
+from utils.cache import SQLiteStore
+from utils.tokens import count_tokens
+from utils.tracing import span
+
+
+class CompletionCache:
+    """
+    A cache of LLM completions on a SQLite file, keyed by the hash of the LLM parameters and the full prompt.
+    The file can be shared by multiple processes on the same host.
+    Only deterministic LLMs (like temperature=0) should be cached.
+
+    @param path: path to the SQLite file
+    @param max_entries: maximum number of completions to keep, evicting the least recently used ones
+    """
+
+    store: SQLiteStore
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.store = SQLiteStore(path, max_entries)
+        self._lock = threading.Lock()
+
+    def key(self, llm: BaseLLM, prompt: str) -> str:
+        params = {"type": llm._llm_type, **llm._identifying_params}
+        body = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str) + "\0" + prompt
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        data = self.store.get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data.decode("utf-8") if data is not None else None
+
+    def set(self, key: str, completion: str):
+        self.store.set(key, completion.encode("utf-8"))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        @return: cache statistics, like {"hits": 10, "misses": 2, "hit_rate": 0.83}
+        """
+
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total > 0 else 0.0}
+
+
+async def cached_completion(
+    cache: Optional[CompletionCache], llm: BaseLLM, prompt: str, complete: Callable[[], Awaitable[str]]
+) -> str:
+    """
+    Return the cached completion of the prompt if any, otherwise complete it and cache the result.
+    The call is traced with the token counts and whether the cache is hit.
+
+    @param cache: cache to use, or None to always complete
+    @param llm: the LLM completing the prompt, whose parameters are part of the key
+    @param prompt: the full prompt
+    @param complete: function to complete the prompt on a cache miss
+    """
+
+    model = getattr(llm, "model_name", "")
+    with span("llm.completion", model=model) as s:
+        if s.recording:
+            s.set("prompt_tokens", count_tokens(prompt, model))
+
+        if cache is None:
+            completion = await complete()
+        else:
+            loop = asyncio.get_running_loop()
+            key = cache.key(llm, prompt)
+            completion = await loop.run_in_executor(None, cache.get, key)
+            s.set("cache_hit", completion is not None)
+            if completion is None:
+                completion = await complete()
+                await loop.run_in_executor(None, cache.set, key, completion)
+
+        if s.recording:
+            s.set("completion_tokens", count_tokens(completion, model))
+        return completion
+
+
+async def arun_chain(chain: LLMChain, completion_cache: Optional[CompletionCache] = None, **inputs: str) -> str:
+    """
+    Run an LLMChain without blocking the event loop.
+    The async interface of the LLM is used if implemented, otherwise the call is offloaded to a thread.
+
+    @param chain: chain to run
+    @param completion_cache: cache of the completions, or None to always call the LLM
+    @param inputs: input variables of the prompt
+    @return: output of the chain
+    """
+
+    async def complete() -> str:
+        try:
+            return await chain.arun(**inputs)
+        except NotImplementedError:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(chain.run, **inputs))
+
+    return await cached_completion(completion_cache, chain.llm, chain.prompt.format(**inputs), complete)
@@ -0,0 +1,32 @@
+import threading
+from typing import Any, Dict, List
+
+
+class Metrics:
+    """
+    Counters and observed values collected during executions, like the number of LLM calls or prompt tokens.
+    """
+
+    counters: Dict[str, int]
+    values: Dict[str, List[float]]
+
+    def __init__(self):
+        self.counters = {}
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.values.setdefault(name, []).append(value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        @return: counters and observed values, like {"plan_llm_calls": 3, "plan_prompt_tokens": [812, 901, 977]}
+        """
+
+        with self._lock:
+            return {**self.counters, **{name: list(values) for name, values in self.values.items()}}
@@ -0,0 +1,36 @@
+import functools
+import math
+from typing import Optional
+import tiktoken
+
+# Characters per token to approximate the count without an encoding,
+# lower than the average of about 4 for English so that token budgets are rather underused than exceeded
+CHARS_PER_TOKEN = 3
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str) -> Optional[tiktoken.Encoding]:
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding files are downloaded on first use, which fails offline
+        return None
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    """
+    Count the tokens of a text, with the encoding of the given model if known.
+    If the encoding cannot be loaded, the count is approximated from the length of the text.
+
+    @param text: text to count
+    @param model: model name like "text-davinci-003"
+    @return: number of tokens
+    """
+
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,213 @@
+import abc
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar
+
+
+class Span:
+    """
+    A timed operation in a trace, like an LLM call or a command execution.
+
+    @param name: name of the operation, like "executor.execute"
+    @param trace_id: id shared by all the spans of a trace
+    @param span_id: id of the span
+    @param parent_span_id: id of the enclosing span, or None for the root span
+    @param attributes: details of the operation, like token counts or cache hits
+    @param error: error message if the operation failed, otherwise empty string
+    """
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    start_time: float
+    end_time: Optional[float] = None
+    attributes: Dict[str, Any]
+    error: str = ""
+
+    # Whether the span is exported, to skip computing expensive attributes otherwise
+    recording: bool = True
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent is not None else None
+        self.start_time = time.time()
+        self.attributes = dict(attributes or {})
+
+    @property
+    def duration(self) -> float:
+        """
+        @return: seconds from the start to the end (or now, if not ended)
+        """
+
+        return (self.end_time if self.end_time is not None else time.time()) - self.start_time
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, error: str):
+        """
+        Mark the span as failed, ignoring an empty error message.
+        """
+
+        if error:
+            self.error = error
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        @return: the span in an OTLP-like form
+        """
+
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": int(self.start_time * 1e9),
+            "end_time_unix_nano": int(self.end_time * 1e9) if self.end_time is not None else None,
+            "duration_ms": self.duration * 1000,
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+class _NoopSpan(Span):
+    recording = False
+
+    def __init__(self):
+        super().__init__("noop")
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def set_error(self, error: str):
+        pass
+
+
+class SpanExporter(metaclass=abc.ABCMeta):
+    """
+    Receives the spans as they end.
+    """
+
+    @abc.abstractmethod
+    def export(self, span: Span):
+        raise NotImplementedError()
+
+
+class JSONLSpanExporter(SpanExporter):
+    """
+    Appends the spans to a local JSONL file, one span per line, to be analyzed offline.
+
+    @param path: path to the JSONL file
+    """
+
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_json(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+_NOOP_SPAN = _NoopSpan()
+_exporter: Optional[SpanExporter] = None
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+def set_exporter(exporter: Optional[SpanExporter]):
+    """
+    Enable tracing with the exporter, or disable it with None (the default).
+    """
+
+    global _exporter
+    _exporter = exporter
+
+
+def current_span() -> Span:
+    """
+    @return: the innermost span in the current context, or a span recording nothing if there is none
+    """
+
+    span = _current.get()
+    return span if span is not None else _NOOP_SPAN
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Trace the enclosed block as a child of the current span.
+    Spans started in tasks created inside the block (like with asyncio.gather) are its children too.
+    An exception raised in the block is recorded as the error.
+    """
+
+    if _exporter is None:
+        yield _NOOP_SPAN
+        return
+
+    s = Span(name, _current.get(), attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.set_error(str(e) or type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        s.end_time = time.time()
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(s)
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def traced(name: str, on_result: Optional[Callable[[Span, Any], None]] = None, **attributes: Any) -> Callable[[F], F]:
+    """
+    Trace each call of the decorated function or coroutine function.
+
+    @param name: name of the spans
+    @param on_result: called with the span and the returned value, to record details of the result
+    @param attributes: attributes set to every span
+    """
+
+    def decorator(fn: F) -> F:
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(name, **attributes) as s:
+                    result = await fn(*args, **kwargs)
+                    if on_result is not None and s.recording:
+                        on_result(s, result)
+                    return result
+
+            return async_wrapper  # type: ignore
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name, **attributes) as s:
+                result = fn(*args, **kwargs)
+                if on_result is not None and s.recording:
+                    on_result(s, result)
+                return result
+
+        return wrapper  # type: ignore
+
+    return decorator